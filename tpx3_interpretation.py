@@ -2,86 +2,159 @@ from tqdm import tqdm
 import numpy as np
 import tables as tb
 import sys
+import os
+import time
+import argparse
+import contextlib
+import tempfile
+import shutil
 import multiprocessing
+import multiprocessing.pool
+import threading
+import platform
+import json
+import atexit
+import queue
+import zlib
 
 from basil.utils.BitLogic import BitLogic
 
-class AssignmentError(Exception):
+# h5py is only needed to find the file offset of the raw data for memory mapping
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+class InterpretationError(Exception):
     def __init__(self, message):
         self.message = message
 
-# Initialize the look up tables for decoding
-_lfsr_4_lut = np.zeros((2 ** 4), dtype=np.uint16)
-_lfsr_10_lut = np.zeros((2 ** 10), dtype=np.uint16)
-_lfsr_14_lut = np.zeros((2 ** 14), dtype=np.uint16)
-_gray_14_lut = np.zeros((2 ** 14), dtype=np.uint16)
-
-# Fill the 4-bit LFSR look up table
-lfsr = BitLogic(4)
-lfsr[3:0] = 0xF
-dummy = 0
-for i in range(2**4):
-    _lfsr_4_lut[BitLogic.tovalue(lfsr)] = i
-    dummy = lfsr[3]
-    lfsr[3] = lfsr[2]
-    lfsr[2] = lfsr[1]
-    lfsr[1] = lfsr[0]
-    lfsr[0] = lfsr[3] ^ dummy
-_lfsr_4_lut[2 ** 4 - 1] = 0
-
-# Fill the 10-bit LFSR look up table
-lfsr = BitLogic(10)
-lfsr[7:0] = 0xFF
-lfsr[9:8] = 0b11
-dummy = 0
-for i in range(2 ** 10):
-    _lfsr_10_lut[BitLogic.tovalue(lfsr)] = i
-    dummy = lfsr[9]
-    lfsr[9] = lfsr[8]
-    lfsr[8] = lfsr[7]
-    lfsr[7] = lfsr[6]
-    lfsr[6] = lfsr[5]
-    lfsr[5] = lfsr[4]
-    lfsr[4] = lfsr[3]
-    lfsr[3] = lfsr[2]
-    lfsr[2] = lfsr[1]
-    lfsr[1] = lfsr[0]
-    lfsr[0] = lfsr[7] ^ dummy
-_lfsr_10_lut[2 ** 10 - 1] = 0
-
-# Fill the 14-bit LFSR look up table
-lfsr = BitLogic(14)
-lfsr[7:0] = 0xFF
-lfsr[13:8] = 63
-dummy = 0
-for i in range(2**14):
-    _lfsr_14_lut[BitLogic.tovalue(lfsr)] = i
-    dummy = lfsr[13]
-    lfsr[13] = lfsr[12]
-    lfsr[12] = lfsr[11]
-    lfsr[11] = lfsr[10]
-    lfsr[10] = lfsr[9]
-    lfsr[9] = lfsr[8]
-    lfsr[8] = lfsr[7]
-    lfsr[7] = lfsr[6]
-    lfsr[6] = lfsr[5]
-    lfsr[5] = lfsr[4]
-    lfsr[4] = lfsr[3]
-    lfsr[3] = lfsr[2]
-    lfsr[2] = lfsr[1]
-    lfsr[1] = lfsr[0]
-    lfsr[0] = lfsr[2] ^ dummy ^ lfsr[12] ^ lfsr[13]
-_lfsr_14_lut[2 ** 14 - 1] = 0
-
-# Fill the 14-bit gray look up table
-for j in range(2**14):
-    encoded_value = BitLogic(14) #48
-    encoded_value[13:0]=j #47
-    gray_decrypt_v = BitLogic(14) #48
-    gray_decrypt_v[13]=encoded_value[13] #47
-    for i in range (12, -1, -1): #46
-        gray_decrypt_v[i]=gray_decrypt_v[i+1]^encoded_value[i]
-    _gray_14_lut[j] = gray_decrypt_v.tovalue()
+# Look up tables for decoding, they are filled by init_luts once per process
+_lfsr_4_lut = None
+_lfsr_10_lut = None
+_lfsr_14_lut = None
+_gray_14_lut = None
+
+# Data type of the interpreted hits
+hit_data_type = {'names': ['data_header', 'header', 'hit_index', 'x',     'y',     'TOA',    'TOT',    'EventCounter', 'HitCounter', 'FTOA',  'scan_param_id', 'chunk_start_time', 'iTOT',   'TOA_Extension', 'TOA_Combined'],
+                 'formats': ['uint8',       'uint8',  'uint64', 'uint8', 'uint8', 'uint16', 'uint16', 'uint16',       'uint8',      'uint8', 'uint16',        'float',            'uint16', 'uint64',        'uint64']}
+
+# Data type of the progress table with the completed slices (chunk range, raw data range and number of hits)
+progress_type = {'names': ['slice_start', 'slice_stop', 'index_start', 'index_stop', 'hits', 'total_hits'],
+                 'formats': ['uint64',     'uint64',     'uint64',      'uint64',     'uint64', 'uint64']}
+
+# Data type of the decode statistics of a slice: words, paired and unpaired words, ToA extension mismatches
+# before and after the correction and the units that are discarded (per link and for each reason)
+decode_stats_type = {'names': ['slice_start', 'slice_stop', 'words',         'paired_words',  'unpaired_words', 'extension_mismatches', 'remaining_extension_mismatches', 'link_mismatch_units', 'timestamp_mismatch_units', 'missing_timestamp_units', 'failed_tasks', 'failed_units', 'dropped_units', 'dropped_hits'],
+                     'formats': ['uint64',     'uint64',     ('uint64', 8), ('uint64', 8), ('uint64', 8),   ('uint64', 8),          ('uint64', 8),                    ('uint64', 8),         'uint64',                   'uint64',                  'uint64',       'uint64',       'uint64',        'uint64']}
+
+# Data type of the frame index with the ToA window and the number of hits of each frame
+frame_index_type = {'names': ['window', 'toa_start', 'hits'],
+                    'formats': ['uint64', 'uint64',   'uint64']}
+
+# Number of frames that are binned at once, maximum number of open frames of the frame builder
+# and number of hits read at once from an output file
+frame_batch = 64
+frame_open_max = 256
+frame_block_hits = 1000000
+
+# Chunk cache for reading chunked raw data with PyTables: large enough for the chunks
+# of a readout chunk, fully read chunks are removed first from the cache
+raw_chunk_cache_size = 64 * 1024 * 1024
+raw_chunk_cache_nelmts = 1021
+raw_chunk_cache_preempt = 1.0
+
+# Size of the interpretation tasks in words: consecutive chunks are combined to tasks of about
+# task_words words, which is adapted to take about task_latency seconds per task. Larger chunks are split
+task_words = 200000
+task_words_min = 10000
+task_words_max = 4000000
+task_latency = 0.5
+
+# HDF5 is not thread safe, with the thread backend all PyTables access is serialized
+_hdf5_lock = threading.Lock()
+
+# Files with more chunks are interpreted in slices with up to slice_packages packages
+slice_chunks = 50000
+slice_packages = 400000000
+
+def init_luts():
+    # Initialize the look up tables for decoding, only on first use in each process
+    global _lfsr_4_lut, _lfsr_10_lut, _lfsr_14_lut, _gray_14_lut
+    if _gray_14_lut is not None:
+        return
+    lfsr_4_lut = np.zeros((2 ** 4), dtype=np.uint16)
+    lfsr_10_lut = np.zeros((2 ** 10), dtype=np.uint16)
+    lfsr_14_lut = np.zeros((2 ** 14), dtype=np.uint16)
+
+    # Fill the 4-bit LFSR look up table
+    lfsr = BitLogic(4)
+    lfsr[3:0] = 0xF
+    dummy = 0
+    for i in range(2**4):
+        lfsr_4_lut[BitLogic.tovalue(lfsr)] = i
+        dummy = lfsr[3]
+        lfsr[3] = lfsr[2]
+        lfsr[2] = lfsr[1]
+        lfsr[1] = lfsr[0]
+        lfsr[0] = lfsr[3] ^ dummy
+    lfsr_4_lut[2 ** 4 - 1] = 0
+
+    # Fill the 10-bit LFSR look up table
+    lfsr = BitLogic(10)
+    lfsr[7:0] = 0xFF
+    lfsr[9:8] = 0b11
+    dummy = 0
+    for i in range(2 ** 10):
+        lfsr_10_lut[BitLogic.tovalue(lfsr)] = i
+        dummy = lfsr[9]
+        lfsr[9] = lfsr[8]
+        lfsr[8] = lfsr[7]
+        lfsr[7] = lfsr[6]
+        lfsr[6] = lfsr[5]
+        lfsr[5] = lfsr[4]
+        lfsr[4] = lfsr[3]
+        lfsr[3] = lfsr[2]
+        lfsr[2] = lfsr[1]
+        lfsr[1] = lfsr[0]
+        lfsr[0] = lfsr[7] ^ dummy
+    lfsr_10_lut[2 ** 10 - 1] = 0
+
+    # Fill the 14-bit LFSR look up table
+    lfsr = BitLogic(14)
+    lfsr[7:0] = 0xFF
+    lfsr[13:8] = 63
+    dummy = 0
+    for i in range(2**14):
+        lfsr_14_lut[BitLogic.tovalue(lfsr)] = i
+        dummy = lfsr[13]
+        lfsr[13] = lfsr[12]
+        lfsr[12] = lfsr[11]
+        lfsr[11] = lfsr[10]
+        lfsr[10] = lfsr[9]
+        lfsr[9] = lfsr[8]
+        lfsr[8] = lfsr[7]
+        lfsr[7] = lfsr[6]
+        lfsr[6] = lfsr[5]
+        lfsr[5] = lfsr[4]
+        lfsr[4] = lfsr[3]
+        lfsr[3] = lfsr[2]
+        lfsr[2] = lfsr[1]
+        lfsr[1] = lfsr[0]
+        lfsr[0] = lfsr[2] ^ dummy ^ lfsr[12] ^ lfsr[13]
+    lfsr_14_lut[2 ** 14 - 1] = 0
+
+    # Fill the 14-bit gray look up table: each bit is the xor of all higher bits of the gray code
+    gray_14_lut = np.arange(2 ** 14, dtype=np.uint16)
+    shift = 1
+    while shift < 14:
+        gray_14_lut ^= gray_14_lut >> shift
+        shift *= 2
+
+    _lfsr_4_lut = lfsr_4_lut
+    _lfsr_10_lut = lfsr_10_lut
+    _lfsr_14_lut = lfsr_14_lut
+    _gray_14_lut = gray_14_lut
 
 def exp(x, a, b, c):
     return np.exp(a*x + b) + c
@@ -92,16 +165,151 @@ def timewalk_correction(tot, a, b, c):
     ftoa_offset = (np.round(np.mod(timewalk, 25) / 1.5625)).astype(int)
     return toa_offset, ftoa_offset
 
+class HDF5RawData:
+    # Reads the raw data words with PyTables using a chunk cache tuned for the readout chunks
+    backend = 'hdf5'
+
+    def __init__(self, input_filename):
+        self.input_filename = input_filename
+        with _hdf5_lock:
+            self.h5_file = tb.open_file(input_filename, 'r', CHUNK_CACHE_SIZE=raw_chunk_cache_size, CHUNK_CACHE_NELMTS=raw_chunk_cache_nelmts, CHUNK_CACHE_PREEMPT=raw_chunk_cache_preempt)
+            self.raw_data = self.h5_file.root.raw_data
+
+    def read(self, indices):
+        if len(indices) == 0:
+            return np.zeros(0, dtype=np.uint32)
+        # The indices of a chunk are nearly contiguous, so the covered range is read as one slice
+        # and the words are selected in memory instead of a slow point selection in HDF5
+        first = indices.min()
+        last = indices.max() + 1
+        with _hdf5_lock:
+            if last - first > 2 * len(indices):
+                return self.raw_data[indices]
+            raw_data = self.raw_data[first:last]
+        return raw_data[indices - first]
+
+    def close(self):
+        with _hdf5_lock:
+            self.h5_file.close()
+
+class MemmapRawData:
+    # Maps the words of a contiguous, uncompressed raw data dataset directly from the file,
+    # so that all processes share the pages of the page cache instead of copying the data
+    backend = 'memmap'
+
+    def __init__(self, input_filename, offset, shape):
+        self.input_filename = input_filename
+        self.raw_data = np.memmap(input_filename, dtype='<u4', mode='r', offset=offset, shape=shape)
+
+    def read(self, indices):
+        return self.raw_data[indices]
+
+    def close(self):
+        self.raw_data = None
+
+def raw_data_layout(input_filename):
+    # Returns the file offset and the shape of the raw data if it can be memory mapped, otherwise
+    # the reason why this is not possible
+    if h5py is None:
+        return None, "h5py is not installed"
+    with _hdf5_lock:
+        with h5py.File(input_filename, 'r') as h5_file_in:
+            raw_data = h5_file_in['raw_data']
+            if raw_data.id.get_create_plist().get_layout() != h5py.h5d.CONTIGUOUS:
+                return None, "raw data is stored in chunks"
+            if raw_data.dtype != np.dtype('<u4'):
+                return None, "raw data is not stored as little endian uint32"
+            offset = raw_data.id.get_offset()
+            if offset is None:
+                return None, "raw data has no storage in the file"
+            return (offset, raw_data.shape), None
+
+def open_raw_data(input_filename, backend='auto'):
+    # Open the raw data with the memmap backend if possible (or requested) and otherwise with PyTables
+    if backend in ['auto', 'memmap']:
+        layout, reason = raw_data_layout(input_filename)
+        if layout is not None:
+            return MemmapRawData(input_filename, *layout)
+        if backend == 'memmap':
+            print("Raw data can not be memory mapped (" + reason + "), use --repack to convert the input file")
+    return HDF5RawData(input_filename)
+
+# Raw data readers of the current process, they are opened once per process and input file
+# and shared by the threads of the process. Each reader is stored with the identity of the file
+# (inode, modification time and size), a file that was replaced or changed since gets a new reader
+_raw_data_readers = {}
+_raw_data_readers_lock = threading.Lock()
+
+def get_raw_data(input_filename, backend='auto'):
+    stat = os.stat(input_filename)
+    identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    key = (os.getpid(), input_filename, backend)
+    with _raw_data_readers_lock:
+        if key in _raw_data_readers and _raw_data_readers[key][0] != identity:
+            _raw_data_readers.pop(key)[1].close()
+        if key not in _raw_data_readers:
+            _raw_data_readers[key] = (identity, open_raw_data(input_filename, backend))
+        return _raw_data_readers[key][1]
+
+def close_raw_data(input_filename=None):
+    # Close the raw data readers of the current process for the input file (or for all files)
+    with _raw_data_readers_lock:
+        for key in list(_raw_data_readers):
+            if key[0] == os.getpid() and (input_filename is None or key[1] == input_filename):
+                _raw_data_readers.pop(key)[1].close()
+
+# Worker processes keep their readers until they exit
+atexit.register(close_raw_data)
+
+def repack_raw_data(input_filename, output_filename, block_size=10000000):
+    # Copy an input file with the raw data as contiguous, uncompressed dataset that can be memory mapped
+    print("Repack raw data of", input_filename, "to", output_filename)
+    with tb.open_file(input_filename, 'r') as h5_file_in:
+        with tb.open_file(output_filename, 'w') as h5_file_out:
+            raw_data = h5_file_in.root.raw_data
+            raw_data_out = h5_file_out.create_array(h5_file_out.root, 'raw_data', atom=tb.UInt32Atom(), shape=(raw_data.nrows,), title=raw_data.title)
+            for start in tqdm(range(0, raw_data.nrows, block_size), desc="Block"):
+                raw_data_out[start:start + block_size] = raw_data[start:start + block_size]
+            for name in raw_data.attrs._v_attrnamesuser:
+                raw_data_out.attrs[name] = raw_data.attrs[name]
+
+            # Copy the meta data, the configuration and the file attributes unchanged
+            for node in h5_file_in.root:
+                if node._v_name != 'raw_data':
+                    h5_file_in.copy_node(node, h5_file_out.root, recursive=True)
+            h5_file_in.root._v_attrs._f_copy(h5_file_out.root)
+
+def pair_words(words0_units, words1_units, units):
+    # Pair the n-th word 0 with the n-th word 1 of each unit and return the positions of the paired words.
+    # A unit can contain one unpaired word 0 or word 1 at the end, units with more unpaired words are returned as bad units
+    counts0 = np.bincount(words0_units, minlength=units)
+    counts1 = np.bincount(words1_units, minlength=units)
+    pairs = np.minimum(counts0, counts1)
+    bad_units = np.where(np.abs(counts0 - counts1) > 1)[0]
+    pairs[bad_units] = 0
+
+    # The words are ordered by unit, so the position within the unit follows from the first word of the unit
+    words0_pairs = np.where(np.arange(len(words0_units)) - (np.cumsum(counts0) - counts0)[words0_units] < pairs[words0_units])[0]
+    words1_pairs = np.where(np.arange(len(words1_units)) - (np.cumsum(counts1) - counts1)[words1_units] < pairs[words1_units])[0]
+    return words0_pairs, words1_pairs, bad_units
+
 def interpret_data(args):
+    # Interpret the words of a task and return the hits and the decode statistics of the task
+    init_luts()
+    stats = np.zeros(1, dtype=decode_stats_type)
     try:
-        input_filename, raw_indices, op_mode, vco, scan_id, scan_param_id, chunk_start_time, start_indices, timewalk_calib, timewalk_a, timewalk_b, timewalk_c = args
-        with tb.open_file(input_filename, 'r') as h5_file_in:
-            raw_data = h5_file_in.root.raw_data[raw_indices]
+        input_filename, raw_indices, unit_lengths, op_mode, vco, scan_id, scan_param_id, chunk_start_time, start_indices, timewalk_calib, timewalk_a, timewalk_b, timewalk_c, raw_data_backend = args
+        raw_data = get_raw_data(input_filename, raw_data_backend).read(raw_indices)
+
+        # A task consists of several corrected chunks (units), the words are paired within each unit
+        units = len(unit_lengths)
+        raw_units = np.repeat(np.arange(units), unit_lengths)
 
         # Based on the headers, filter for hit words and create a list of these words and a list of their indices
         hit_filter = np.where(np.right_shift(np.bitwise_and(raw_data, 0xf0000000), 28) != 0b0101)
         hits = raw_data[hit_filter]
         hits_indices = raw_indices[hit_filter]
+        hits_units = raw_units[hit_filter]
 
         # Only in "DataTake" the ToA extensions are active
         if scan_id == 'DataTake':
@@ -110,6 +318,7 @@ def interpret_data(args):
             timestamp_filter = np.where(timestamp_map == True)
             timestamps = raw_data[timestamp_filter]
             timestamps_indices = raw_indices[timestamp_filter]
+            timestamps_units = raw_units[timestamp_filter]
 
             # Split the lists in separate lists for word 0 and word 1 (based on header)
             timestamps_0_filter = np.where(np.right_shift(np.bitwise_and(timestamps, 0x3000000), 24) == 0b01)
@@ -117,20 +326,39 @@ def interpret_data(args):
             timestamps_0 = timestamps[timestamps_0_filter].astype(np.uint64)
             timestamps_1 = timestamps[timestamps_1_filter].astype(np.uint64)
             timestamps_0_indices = timestamps_indices[timestamps_0_filter]
-            timestamps_1_indices = timestamps_indices[timestamps_1_filter]
 
             # Combine the timestamp bits of word 0 and word 1 to the full 48-bit ToA extension
-            if len(timestamps_1) == len(timestamps_0):
-                full_timestamps = np.left_shift(np.bitwise_and(timestamps_1, 0xffffff), 24) + np.bitwise_and(timestamps_0, 0xfff000)
-                full_timestamps_indices = timestamps_0_indices
-            elif len(timestamps_1) + 1 == len(timestamps_0):
-                full_timestamps = np.left_shift(np.bitwise_and(timestamps_1, 0xffffff), 24) + np.bitwise_and(timestamps_0[:-1], 0xfff000)
-                full_timestamps_indices = timestamps_0_indices[:-1]
-            elif len(timestamps_1) == len(timestamps_0) + 1:
-                full_timestamps = np.left_shift(np.bitwise_and(timestamps_1[:-1], 0xffffff), 24) + np.bitwise_and(timestamps_0, 0xfff000)
-                full_timestamps_indices = timestamps_0_indices
-            else:
-                raise AssignmentError("Words for timestamps do not match - assignment not possible")
+            timestamps_0_pairs, timestamps_1_pairs, timestamps_bad_units = pair_words(timestamps_units[timestamps_0_filter], timestamps_units[timestamps_1_filter], units)
+            full_timestamps = np.left_shift(np.bitwise_and(timestamps_1[timestamps_1_pairs], 0xffffff), 24) + np.bitwise_and(timestamps_0[timestamps_0_pairs], 0xfff000)
+            full_timestamps_indices = timestamps_0_indices[timestamps_0_pairs]
+            full_timestamps_units = timestamps_units[timestamps_0_filter][timestamps_0_pairs]
+
+            # Hits only get ToA extensions of their own unit, so the extensions are ordered by unit and index
+            # (the indices of different units overlap as the last extension of a chunk is copied to the next chunk)
+            index_offset = raw_indices.min()
+            index_span = raw_indices.max() - index_offset + 1
+            full_timestamps_keys = full_timestamps_units * index_span + (full_timestamps_indices - index_offset)
+            timestamps_sort = np.argsort(full_timestamps_keys, kind='stable')
+            full_timestamps = full_timestamps[timestamps_sort]
+            full_timestamps_keys = full_timestamps_keys[timestamps_sort]
+            timestamps_first = np.searchsorted(full_timestamps_units[timestamps_sort], np.arange(units))
+
+            # Hits in units without ToA extensions can not be assigned (units with unmatched words have no extensions
+            # either, they are only counted as mismatched)
+            mismatched_units = np.zeros(units, dtype=bool)
+            mismatched_units[timestamps_bad_units] = True
+            missing_timestamps_units = np.where((np.bincount(full_timestamps_units, minlength=units) == 0) & (np.bincount(hits_units, minlength=units) > 0) & ~mismatched_units)[0]
+            stats['timestamp_mismatch_units'] = len(timestamps_bad_units)
+            stats['missing_timestamp_units'] = len(missing_timestamps_units)
+            timestamps_bad_units = np.concatenate((timestamps_bad_units, missing_timestamps_units))
+
+            # Without any ToA extension all hits of the task are in discarded units, a placeholder extension
+            # keeps the assignment of the extensions to the hits valid
+            if len(full_timestamps) == 0:
+                full_timestamps = np.zeros(1, dtype=np.uint64)
+                full_timestamps_keys = np.zeros(1, dtype=full_timestamps_keys.dtype)
+        else:
+            timestamps_bad_units = np.zeros(0, dtype=int)
 
         raw_data = None
 
@@ -166,6 +394,16 @@ def interpret_data(args):
         link6_words_indices = hits_indices[link6_hits_filter]
         link7_words_indices = hits_indices[link7_hits_filter]
 
+        # Fourth: Apply the filter also to the units
+        link0_words_units = hits_units[link0_hits_filter]
+        link1_words_units = hits_units[link1_hits_filter]
+        link2_words_units = hits_units[link2_hits_filter]
+        link3_words_units = hits_units[link3_hits_filter]
+        link4_words_units = hits_units[link4_hits_filter]
+        link5_words_units = hits_units[link5_hits_filter]
+        link6_words_units = hits_units[link6_hits_filter]
+        link7_words_units = hits_units[link7_hits_filter]
+
         # Split the hit list for the links up into separate lists with word 0 and word 1
         # First: create the filter
         link0_words0_filter = np.where(np.right_shift(np.bitwise_and(link0_words, 0x1000000), 24) == 0b0)
@@ -205,123 +443,73 @@ def interpret_data(args):
 
         # Third: Combine word 0 and word 1 to the full 48-bit hit word
         # Fourth: Apply the filter to the indices - Use the index of word 0 als index for the full hit
-        if len(link0_words0) == len(link0_words1):
-            link0_hits = np.left_shift(link0_words0, 24) + link0_words1
-            link0_hits_indices = link0_words_indices[link0_words0_filter]
-        elif len(link0_words0) + 1 == len(link0_words1):
-            link0_hits = np.left_shift(link0_words0, 24) + link0_words1[:-1]
-            link0_hits_indices = link0_words_indices[link0_words0_filter]
-        elif len(link0_words0) == len(link0_words1) + 1:
-            link0_hits = np.left_shift(link0_words0[:-1], 24) + link0_words1
-            link0_hits_indices = link0_words_indices[link0_words0_filter[:-1]]
-        else:
-            raise AssignmentError("Words on link 0 do not match - assignment not possible")
-
-        if len(link1_words0) == len(link1_words1):
-            link1_hits = np.left_shift(link1_words0, 24) + link1_words1
-            link1_hits_indices = link1_words_indices[link1_words0_filter]
-        elif len(link1_words0) + 1 == len(link1_words1):
-            link1_hits = np.left_shift(link1_words0, 24) + link1_words1[:-1]
-            link1_hits_indices = link1_words_indices[link1_words0_filter]
-        elif len(link1_words0) == len(link1_words1) + 1:
-            link1_hits = np.left_shift(link1_words0[:-1], 24) + link1_words1
-            link1_hits_indices = link1_words_indices[link1_words0_filter[:-1]]
-        else:
-            raise AssignmentError("Words on link 1 do not match - assignment not possible")
-
-        if len(link2_words0) == len(link2_words1):
-            link2_hits = np.left_shift(link2_words0, 24) + link2_words1
-            link2_hits_indices = link2_words_indices[link2_words0_filter]
-        elif len(link2_words0) + 1 == len(link2_words1):
-            link2_hits = np.left_shift(link2_words0, 24) + link2_words1[:-1]
-            link2_hits_indices = link2_words_indices[link2_words0_filter]
-        elif len(link2_words0) == len(link2_words1) + 1:
-            link2_hits = np.left_shift(link2_words0[:-1], 24) + link2_words1
-            link2_hits_indices = link2_words_indices[link2_words0_filter[:-1]]
-        else:
-            raise AssignmentError("Words on link 2 do not match - assignment not possible")
-
-        if len(link3_words0) == len(link3_words1):
-            link3_hits = np.left_shift(link3_words0, 24) + link3_words1
-            link3_hits_indices = link3_words_indices[link3_words0_filter]
-        elif len(link3_words0) + 1 == len(link3_words1):
-            link3_hits = np.left_shift(link3_words0, 24) + link3_words1[:-1]
-            link3_hits_indices = link3_words_indices[link3_words0_filter]
-        elif len(link3_words0) == len(link3_words1) + 1:
-            link3_hits = np.left_shift(link3_words0[:-1], 24) + link3_words1
-            link3_hits_indices = link3_words_indices[link3_words0_filter[:-1]]
-        else:
-            raise AssignmentError("Words on link 3 do not match - assignment not possible")
-
-        if len(link4_words0) == len(link4_words1):
-            link4_hits = np.left_shift(link4_words0, 24) + link4_words1
-            link4_hits_indices = link4_words_indices[link4_words0_filter]
-        elif len(link4_words0) + 1 == len(link4_words1):
-            link4_hits = np.left_shift(link4_words0, 24) + link4_words1[:-1]
-            link4_hits_indices = link4_words_indices[link4_words0_filter]
-        elif len(link4_words0) == len(link4_words1) + 1:
-            link4_hits = np.left_shift(link4_words0[:-1], 24) + link4_words1
-            link4_hits_indices = link4_words_indices[link4_words0_filter[:-1]]
-        else:
-            raise AssignmentError("Words on link 4 do not match - assignment not possible")
-
-        if len(link5_words0) == len(link5_words1):
-            link5_hits = np.left_shift(link5_words0, 24) + link5_words1
-            link5_hits_indices = link5_words_indices[link5_words0_filter]
-        elif len(link5_words0) + 1 == len(link5_words1):
-            link5_hits = np.left_shift(link5_words0, 24) + link5_words1[:-1]
-            link5_hits_indices = link5_words_indices[link5_words0_filter]
-        elif len(link5_words0) == len(link5_words1) + 1:
-            link5_hits = np.left_shift(link5_words0[:-1], 24) + link5_words1
-            link5_hits_indices = link5_words_indices[link5_words0_filter[:-1]]
-        else:
-            raise AssignmentError("Words on link 5 do not match - assignment not possible")
-
-        if len(link6_words0) == len(link6_words1):
-            link6_hits = np.left_shift(link6_words0, 24) + link6_words1
-            link6_hits_indices = link6_words_indices[link6_words0_filter]
-        elif len(link6_words0) + 1 == len(link6_words1):
-            link6_hits = np.left_shift(link6_words0, 24) + link6_words1[:-1]
-            link6_hits_indices = link6_words_indices[link6_words0_filter]
-        elif len(link6_words0) == len(link6_words1) + 1:
-            link6_hits = np.left_shift(link6_words0[:-1], 24) + link6_words1
-            link6_hits_indices = link6_words_indices[link6_words0_filter[:-1]]
-        else:
-            raise AssignmentError("Words on link 6 do not match - assignment not possible")
-
-        if len(link7_words0) == len(link7_words1):
-            link7_hits = np.left_shift(link7_words0, 24) + link7_words1
-            link7_hits_indices = link7_words_indices[link7_words0_filter]
-        elif len(link7_words0) + 1 == len(link7_words1):
-            link7_hits = np.left_shift(link7_words0, 24) + link7_words1[:-1]
-            link7_hits_indices = link7_words_indices[link7_words0_filter]
-        elif len(link7_words0) == len(link7_words1) + 1:
-            link7_hits = np.left_shift(link7_words0[:-1], 24) + link7_words1
-            link7_hits_indices = link7_words_indices[link7_words0_filter[:-1]]
-        else:
-            raise AssignmentError("Words on link 7 do not match - assignment not possible")
+        link0_words0_pairs, link0_words1_pairs, link0_bad_units = pair_words(link0_words_units[link0_words0_filter], link0_words_units[link0_words1_filter], units)
+        link0_hits = np.left_shift(link0_words0[link0_words0_pairs], 24) + link0_words1[link0_words1_pairs]
+        link0_hits_indices = link0_words_indices[link0_words0_filter][link0_words0_pairs]
+        link0_hits_units = link0_words_units[link0_words0_filter][link0_words0_pairs]
+
+        link1_words0_pairs, link1_words1_pairs, link1_bad_units = pair_words(link1_words_units[link1_words0_filter], link1_words_units[link1_words1_filter], units)
+        link1_hits = np.left_shift(link1_words0[link1_words0_pairs], 24) + link1_words1[link1_words1_pairs]
+        link1_hits_indices = link1_words_indices[link1_words0_filter][link1_words0_pairs]
+        link1_hits_units = link1_words_units[link1_words0_filter][link1_words0_pairs]
+
+        link2_words0_pairs, link2_words1_pairs, link2_bad_units = pair_words(link2_words_units[link2_words0_filter], link2_words_units[link2_words1_filter], units)
+        link2_hits = np.left_shift(link2_words0[link2_words0_pairs], 24) + link2_words1[link2_words1_pairs]
+        link2_hits_indices = link2_words_indices[link2_words0_filter][link2_words0_pairs]
+        link2_hits_units = link2_words_units[link2_words0_filter][link2_words0_pairs]
+
+        link3_words0_pairs, link3_words1_pairs, link3_bad_units = pair_words(link3_words_units[link3_words0_filter], link3_words_units[link3_words1_filter], units)
+        link3_hits = np.left_shift(link3_words0[link3_words0_pairs], 24) + link3_words1[link3_words1_pairs]
+        link3_hits_indices = link3_words_indices[link3_words0_filter][link3_words0_pairs]
+        link3_hits_units = link3_words_units[link3_words0_filter][link3_words0_pairs]
+
+        link4_words0_pairs, link4_words1_pairs, link4_bad_units = pair_words(link4_words_units[link4_words0_filter], link4_words_units[link4_words1_filter], units)
+        link4_hits = np.left_shift(link4_words0[link4_words0_pairs], 24) + link4_words1[link4_words1_pairs]
+        link4_hits_indices = link4_words_indices[link4_words0_filter][link4_words0_pairs]
+        link4_hits_units = link4_words_units[link4_words0_filter][link4_words0_pairs]
+
+        link5_words0_pairs, link5_words1_pairs, link5_bad_units = pair_words(link5_words_units[link5_words0_filter], link5_words_units[link5_words1_filter], units)
+        link5_hits = np.left_shift(link5_words0[link5_words0_pairs], 24) + link5_words1[link5_words1_pairs]
+        link5_hits_indices = link5_words_indices[link5_words0_filter][link5_words0_pairs]
+        link5_hits_units = link5_words_units[link5_words0_filter][link5_words0_pairs]
+
+        link6_words0_pairs, link6_words1_pairs, link6_bad_units = pair_words(link6_words_units[link6_words0_filter], link6_words_units[link6_words1_filter], units)
+        link6_hits = np.left_shift(link6_words0[link6_words0_pairs], 24) + link6_words1[link6_words1_pairs]
+        link6_hits_indices = link6_words_indices[link6_words0_filter][link6_words0_pairs]
+        link6_hits_units = link6_words_units[link6_words0_filter][link6_words0_pairs]
+
+        link7_words0_pairs, link7_words1_pairs, link7_bad_units = pair_words(link7_words_units[link7_words0_filter], link7_words_units[link7_words1_filter], units)
+        link7_hits = np.left_shift(link7_words0[link7_words0_pairs], 24) + link7_words1[link7_words1_pairs]
+        link7_hits_indices = link7_words_indices[link7_words0_filter][link7_words0_pairs]
+        link7_hits_units = link7_words_units[link7_words0_filter][link7_words0_pairs]
+
+        # Count the words of the links and the units that are discarded because of unpaired words
+        stats['words'] = [len(link0_words), len(link1_words), len(link2_words), len(link3_words), len(link4_words), len(link5_words), len(link6_words), len(link7_words)]
+        stats['paired_words'] = [2 * len(link0_hits), 2 * len(link1_hits), 2 * len(link2_hits), 2 * len(link3_hits), 2 * len(link4_hits), 2 * len(link5_hits), 2 * len(link6_hits), 2 * len(link7_hits)]
+        stats['unpaired_words'] = stats['words'] - stats['paired_words']
+        stats['link_mismatch_units'] = [len(link0_bad_units), len(link1_bad_units), len(link2_bad_units), len(link3_bad_units), len(link4_bad_units), len(link5_bad_units), len(link6_bad_units), len(link7_bad_units)]
 
         # When there are ToA extensions combine them with the hits
         if scan_id == 'DataTake':
             # Based on the indices of hits and ToA extensions combine them: Each hit should get the 
-            # extensions with the next lowest index
-            link0_hits_extensions_indices = np.searchsorted(full_timestamps_indices, link0_hits_indices)
-            link1_hits_extensions_indices = np.searchsorted(full_timestamps_indices, link1_hits_indices)
-            link2_hits_extensions_indices = np.searchsorted(full_timestamps_indices, link2_hits_indices)
-            link3_hits_extensions_indices = np.searchsorted(full_timestamps_indices, link3_hits_indices)
-            link4_hits_extensions_indices = np.searchsorted(full_timestamps_indices, link4_hits_indices)
-            link5_hits_extensions_indices = np.searchsorted(full_timestamps_indices, link5_hits_indices)
-            link6_hits_extensions_indices = np.searchsorted(full_timestamps_indices, link6_hits_indices)
-            link7_hits_extensions_indices = np.searchsorted(full_timestamps_indices, link7_hits_indices)
-
-            link0_hits_extensions_indices = np.maximum(link0_hits_extensions_indices - 1, 0)
-            link1_hits_extensions_indices = np.maximum(link1_hits_extensions_indices - 1, 0)
-            link2_hits_extensions_indices = np.maximum(link2_hits_extensions_indices - 1, 0)
-            link3_hits_extensions_indices = np.maximum(link3_hits_extensions_indices - 1, 0)
-            link4_hits_extensions_indices = np.maximum(link4_hits_extensions_indices - 1, 0)
-            link5_hits_extensions_indices = np.maximum(link5_hits_extensions_indices - 1, 0)
-            link6_hits_extensions_indices = np.maximum(link6_hits_extensions_indices - 1, 0)
-            link7_hits_extensions_indices = np.maximum(link7_hits_extensions_indices - 1, 0)
+            # extensions with the next lowest index in its unit
+            link0_hits_extensions_indices = np.searchsorted(full_timestamps_keys, link0_hits_units * index_span + (link0_hits_indices - index_offset))
+            link1_hits_extensions_indices = np.searchsorted(full_timestamps_keys, link1_hits_units * index_span + (link1_hits_indices - index_offset))
+            link2_hits_extensions_indices = np.searchsorted(full_timestamps_keys, link2_hits_units * index_span + (link2_hits_indices - index_offset))
+            link3_hits_extensions_indices = np.searchsorted(full_timestamps_keys, link3_hits_units * index_span + (link3_hits_indices - index_offset))
+            link4_hits_extensions_indices = np.searchsorted(full_timestamps_keys, link4_hits_units * index_span + (link4_hits_indices - index_offset))
+            link5_hits_extensions_indices = np.searchsorted(full_timestamps_keys, link5_hits_units * index_span + (link5_hits_indices - index_offset))
+            link6_hits_extensions_indices = np.searchsorted(full_timestamps_keys, link6_hits_units * index_span + (link6_hits_indices - index_offset))
+            link7_hits_extensions_indices = np.searchsorted(full_timestamps_keys, link7_hits_units * index_span + (link7_hits_indices - index_offset))
+
+            link0_hits_extensions_indices = np.minimum(np.maximum(link0_hits_extensions_indices - 1, timestamps_first[link0_hits_units]), len(full_timestamps) - 1)
+            link1_hits_extensions_indices = np.minimum(np.maximum(link1_hits_extensions_indices - 1, timestamps_first[link1_hits_units]), len(full_timestamps) - 1)
+            link2_hits_extensions_indices = np.minimum(np.maximum(link2_hits_extensions_indices - 1, timestamps_first[link2_hits_units]), len(full_timestamps) - 1)
+            link3_hits_extensions_indices = np.minimum(np.maximum(link3_hits_extensions_indices - 1, timestamps_first[link3_hits_units]), len(full_timestamps) - 1)
+            link4_hits_extensions_indices = np.minimum(np.maximum(link4_hits_extensions_indices - 1, timestamps_first[link4_hits_units]), len(full_timestamps) - 1)
+            link5_hits_extensions_indices = np.minimum(np.maximum(link5_hits_extensions_indices - 1, timestamps_first[link5_hits_units]), len(full_timestamps) - 1)
+            link6_hits_extensions_indices = np.minimum(np.maximum(link6_hits_extensions_indices - 1, timestamps_first[link6_hits_units]), len(full_timestamps) - 1)
+            link7_hits_extensions_indices = np.minimum(np.maximum(link7_hits_extensions_indices - 1, timestamps_first[link7_hits_units]), len(full_timestamps) - 1)
 
             link0_hits_extensions = full_timestamps[link0_hits_extensions_indices]
             link1_hits_extensions = full_timestamps[link1_hits_extensions_indices]
@@ -342,6 +530,7 @@ def interpret_data(args):
             link5_extension_offsets = np.where(np.bitwise_and(link5_hits_extensions, 0x3000) != np.bitwise_and(_gray_14_lut[np.bitwise_and(np.right_shift(link5_hits, 14), 0x3fff)], 0x3000))[0]
             link6_extension_offsets = np.where(np.bitwise_and(link6_hits_extensions, 0x3000) != np.bitwise_and(_gray_14_lut[np.bitwise_and(np.right_shift(link6_hits, 14), 0x3fff)], 0x3000))[0]
             link7_extension_offsets = np.where(np.bitwise_and(link7_hits_extensions, 0x3000) != np.bitwise_and(_gray_14_lut[np.bitwise_and(np.right_shift(link7_hits, 14), 0x3fff)], 0x3000))[0]
+            stats['extension_mismatches'] = [len(link0_extension_offsets), len(link1_extension_offsets), len(link2_extension_offsets), len(link3_extension_offsets), len(link4_extension_offsets), len(link5_extension_offsets), len(link6_extension_offsets), len(link7_extension_offsets)]
 
             # Shift the extension index for hits that dont fulfill the condition by -1
             link0_hits_extensions[link0_extension_offsets] -= 1
@@ -362,13 +551,21 @@ def interpret_data(args):
             link5_extension_offsets = np.where(np.bitwise_and(link5_hits_extensions, 0x3000) != np.bitwise_and(_gray_14_lut[np.bitwise_and(np.right_shift(link5_hits, 14), 0x3fff)], 0x3000))[0]
             link6_extension_offsets = np.where(np.bitwise_and(link6_hits_extensions, 0x3000) != np.bitwise_and(_gray_14_lut[np.bitwise_and(np.right_shift(link6_hits, 14), 0x3fff)], 0x3000))[0]
             link7_extension_offsets = np.where(np.bitwise_and(link7_hits_extensions, 0x3000) != np.bitwise_and(_gray_14_lut[np.bitwise_and(np.right_shift(link7_hits, 14), 0x3fff)], 0x3000))[0]
+            stats['remaining_extension_mismatches'] = [len(link0_extension_offsets), len(link1_extension_offsets), len(link2_extension_offsets), len(link3_extension_offsets), len(link4_extension_offsets), len(link5_extension_offsets), len(link6_extension_offsets), len(link7_extension_offsets)]
 
         # Combine the link specific lists dor hits and their indices
         data = np.concatenate((link0_hits, link1_hits, link2_hits, link3_hits, link4_hits, link5_hits, link6_hits, link7_hits))
         data_indices = np.concatenate((link0_hits_indices, link1_hits_indices, link2_hits_indices, link3_hits_indices, link4_hits_indices, link5_hits_indices, link6_hits_indices, link7_hits_indices))
+        data_units = np.concatenate((link0_hits_units, link1_hits_units, link2_hits_units, link3_hits_units, link4_hits_units, link5_hits_units, link6_hits_units, link7_hits_units))
 
-        # Sort by the indices
-        data_sort = np.argsort(data_indices)
+        # Units with words that can not be assigned are discarded completely
+        bad_units = np.concatenate((timestamps_bad_units, link0_bad_units, link1_bad_units, link2_bad_units, link3_bad_units, link4_bad_units, link5_bad_units, link6_bad_units, link7_bad_units))
+
+        # Sort by the indices, without the hits of the discarded units
+        data_sort = np.where(~np.isin(data_units, bad_units))[0]
+        stats['dropped_units'] = len(np.unique(bad_units))
+        stats['dropped_hits'] = len(data) - len(data_sort)
+        data_sort = data_sort[np.argsort(data_indices[data_sort])]
 
         # Apply the new order based on the indices to get the original order of hits
         data = data[data_sort]
@@ -389,9 +586,7 @@ def interpret_data(args):
         #data_start_indices = start_indices[chunk_indices]
 
         # Create a recarray for the hit data
-        data_type = {'names': ['data_header', 'header', 'hit_index', 'x',     'y',     'TOA',    'TOT',    'EventCounter', 'HitCounter', 'FTOA',  'scan_param_id', 'chunk_start_time', 'iTOT',   'TOA_Extension', 'TOA_Combined'],
-                    'formats': ['uint8',       'uint8',  'uint64', 'uint8', 'uint8', 'uint16', 'uint16', 'uint16',       'uint8',      'uint8', 'uint16',        'float',            'uint16', 'uint64',        'uint64']}
-        pix_data = np.recarray((data.shape[0]), dtype=data_type)
+        pix_data = np.recarray((data.shape[0]), dtype=hit_data_type)
 
         # Create some numpy numbers for the data interpretation
         n47 = np.uint64(47)
@@ -498,23 +693,158 @@ def interpret_data(args):
         #print("Order data by timestamp")
         pix_data = pix_data[pix_data['TOA_Combined'].argsort()]
 
-        return pix_data
+        return pix_data, stats
     except Exception as e:
+        # The units of a failed task are discarded, only the statistics show it
         print(e)
-        data_type = {'names': ['data_header', 'header', 'hit_index', 'x',     'y',     'TOA',    'TOT',    'EventCounter', 'HitCounter', 'FTOA',  'scan_param_id', 'chunk_start_time', 'iTOT',   'TOA_Extension', 'TOA_Combined'],
-                    'formats': ['uint8',       'uint8',  'uint64', 'uint8', 'uint8', 'uint16', 'uint16', 'uint16',       'uint8',      'uint8', 'uint16',        'float',            'uint16', 'uint64',        'uint64']}
-        pix_data = np.recarray((0), dtype=data_type)
-        return pix_data
+        stats = np.zeros(1, dtype=decode_stats_type)
+        stats['failed_tasks'] = 1
+        stats['failed_units'] = len(args[2])
+        stats['dropped_units'] = len(args[2])
+        pix_data = np.recarray((0), dtype=hit_data_type)
+        return pix_data, stats
+
+def create_hit_file(directory, rows):
+    # Create a temporary file for rows hits, the space is reserved so that a full disk is an error here
+    # and not a crash of the workers that write into the memory mapped file
+    handle, filename = tempfile.mkstemp(suffix='.hits', dir=directory)
+    try:
+        size = max(rows, 1) * np.dtype(hit_data_type).itemsize
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(handle, 0, size)
+        else:
+            os.ftruncate(handle, size)
+    except OSError as e:
+        os.close(handle)
+        os.remove(filename)
+        raise InterpretationError("Can not reserve " + str(size // 1024 ** 2) + " MB for the hits in " + filename + " (" + e.strerror + "), use --buffer-dir to choose another directory")
+    os.close(handle)
+    return filename
+
+def interpret_task(args):
+    # Interpret a task and write the hits into the region of the task in the hit buffer of the slice,
+    # so that only the position, the number of hits, the decode statistics and the run time go back to the
+    # parent. Worker processes get the file name of the memory mapped buffer, threads get the buffer itself
+    start_time = time.time()
+    buffer, offset, capacity = args[-3:]
+    pix_data, stats = interpret_data(args[:-3])
+    if len(pix_data) > capacity:
+        raise InterpretationError("More hits than expected in a task (" + str(len(pix_data)) + " of " + str(capacity) + ")")
+    if len(pix_data) > 0:
+        if isinstance(buffer, str):
+            buffer = np.memmap(buffer, dtype=hit_data_type, mode='r+', offset=offset * np.dtype(hit_data_type).itemsize, shape=(len(pix_data),))
+            buffer[:] = pix_data
+            buffer = None
+        else:
+            buffer[offset:offset + len(pix_data)] = pix_data
+    return offset, len(pix_data), stats, time.time() - start_time
+
+def sum_decode_stats(stats):
+    # Sum the decode statistics of several tasks
+    total = np.zeros(1, dtype=decode_stats_type)
+    if len(stats) > 0:
+        stats = np.concatenate(stats)
+        for name in decode_stats_type['names']:
+            total[name] = np.sum(stats[name], axis=0)
+    return total
+
+class SerialPool:
+    # Runs the tasks one after the other in the calling thread, with the interface of multiprocessing.Pool
+    def imap(self, func, iterable, chunksize=1):
+        return map(func, iterable)
+
+    def apply_async(self, func, args=(), callback=None, error_callback=None):
+        try:
+            result = func(*args)
+        except Exception as e:
+            if error_callback is not None:
+                error_callback(e)
+            return
+        if callback is not None:
+            callback(result)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+def pool_backend(pool):
+    # The backend of a pool: threads and the serial pool share the memory of this process
+    if isinstance(pool, SerialPool):
+        return 'serial'
+    if isinstance(pool, multiprocessing.pool.ThreadPool):
+        return 'thread'
+    return 'process'
+
+def compress_chunks(args):
+    # Compress a range of hits into HDF5 chunks of the hit table, with the shuffle and deflate filters of the
+    # table. Worker processes get the file name of the memory mapped hits, threads get the hits themselves
+    hits, start, stop, chunk_rows, complevel = args
+    if isinstance(hits, str):
+        hits = np.memmap(hits, dtype=hit_data_type, mode='r')
+    pix_data = hits[start:stop]
+    chunks = []
+    for start in range(0, len(pix_data), chunk_rows):
+        chunk = np.zeros(chunk_rows, dtype=pix_data.dtype)
+        chunk[:min(chunk_rows, len(pix_data) - start)] = pix_data[start:start + chunk_rows]
+        chunk = np.ascontiguousarray(chunk.view(np.uint8).reshape(chunk_rows, pix_data.dtype.itemsize).T)
+        chunks.append(zlib.compress(chunk, complevel))
+    return chunks
+
+def write_chunks(h5_filename_out, pix_data, pool, tasks, hits_filename=None):
+    # Append the hits to the hit table, the chunks are compressed in parallel by the pool and written
+    # directly into the table without compressing them again. The hits that fill the last chunk of
+    # the table are appended normally before. With hits_filename (a memory mapped copy of the hits)
+    # the workers read their hits from this file
+    with tb.open_file(h5_filename_out, 'a') as h5_file_out:
+        table = h5_file_out.root.interpreted.run_0.hit_data
+        chunk_rows = int(table.chunkshape[0])
+        head = min((-table.nrows) % chunk_rows, len(pix_data))
+        if head > 0:
+            table.append(pix_data[:head])
+            table.flush()
+        nrows = table.nrows
+    hits = hits_filename if hits_filename is not None else np.asarray(pix_data)
+    pix_data = np.asarray(pix_data[head:])
+    if len(pix_data) == 0:
+        return
+
+    with h5py.File(h5_filename_out, 'r+') as h5_file_out:
+        hit_data = h5_file_out['interpreted/run_0/hit_data']
+        filters = hit_data.id.get_create_plist()
+        filters = [filters.get_filter(i)[0] for i in range(filters.get_nfilters())]
+        if hit_data.dtype != pix_data.dtype or filters != [h5py.h5z.FILTER_SHUFFLE, h5py.h5z.FILTER_DEFLATE]:
+            print("Hit table can not be written in chunks, append the hits")
+            with_chunks = False
+        else:
+            with_chunks = True
+            hit_data.resize((nrows + len(pix_data),))
+            task_rows = max(-(-len(pix_data) // (tasks * chunk_rows)), 1) * chunk_rows
+            args = [[hits, head + start, head + min(start + task_rows, len(pix_data)), chunk_rows, hit_data.compression_opts] for start in range(0, len(pix_data), task_rows)]
+            offset = nrows
+            for chunks in pool.imap(compress_chunks, args):
+                for chunk in chunks:
+                    hit_data.id.write_direct_chunk((offset,), chunk)
+                    offset += chunk_rows
+    if not with_chunks:
+        with tb.open_file(h5_filename_out, 'a') as h5_file_out:
+            table = h5_file_out.root.interpreted.run_0.hit_data
+            table.append(pix_data)
+            table.flush()
 
-def save_data(in_file, h5_filename_out, pix_data, append = False):
+def save_data(in_file, h5_filename_out, pix_data, append = False, pool = None, tasks = 1, hits_filename = None):
     # Open the output file
     print("Save data to output file")
+    # With a pool (and h5py) the hits are compressed in parallel and written with write_chunks
+    parallel = pool is not None and h5py is not None
     with tb.open_file(h5_filename_out, 'a') as h5_file_out:    
         # If the interpreted node is already there remove it
         if append:
-            table = h5_file_out.root.interpreted.run_0.hit_data
-            table.append(pix_data)
-            table.flush()
+            if not parallel:
+                table = h5_file_out.root.interpreted.run_0.hit_data
+                table.append(pix_data)
+                table.flush()
         else:
             try:
                 h5_file_out.remove_node(h5_file_out.root.interpreted, recursive=True)
@@ -535,389 +865,1104 @@ def save_data(in_file, h5_filename_out, pix_data, append = False):
             h5_file_out.root.interpreted.run_0._v_attrs['numChips'] = np.array([1])
 
             # Create a table with the interpreted data
-            h5_file_out.create_table(h5_file_out.root.interpreted.run_0, 'hit_data', pix_data, filters=tb.Filters(complib='zlib', complevel=2))
+            # The table gets the same chunk size if it is created empty for the parallel writing
+            if parallel:
+                h5_file_out.create_table(h5_file_out.root.interpreted.run_0, 'hit_data', np.zeros(0, dtype=pix_data.dtype), filters=tb.Filters(complib='zlib', complevel=2),
+                                         expectedrows=max(len(pix_data), h5_file_out.params['EXPECTED_ROWS_TABLE']))
+            else:
+                h5_file_out.create_table(h5_file_out.root.interpreted.run_0, 'hit_data', pix_data, filters=tb.Filters(complib='zlib', complevel=2))
 
             # Copy the chip configuration from the input file to the output file
             h5_file_out.create_group(h5_file_out.root.interpreted.run_0, 'configuration', 'Configuration')
             in_file.copy_children(in_file.root.configuration, h5_file_out.root.interpreted.run_0.configuration)
 
-def error_correction(meta_data, h5_file_in, start_chunk, stop_chunk):
-    # Read the data onto arrays
-    meta_data_tmp = meta_data[start_chunk:stop_chunk]
-    discard_errors = meta_data_tmp['discard_error']
-    decode_errors = meta_data_tmp['decode_error']
-    errors = discard_errors + decode_errors
-    start_indices = meta_data_tmp['index_start']
-    stop_indices = meta_data_tmp['index_stop']
-    indices = np.array([np.arange(start, stop, 1, dtype=int) for start, stop in zip(start_indices, stop_indices)], dtype=object)
-    scan_param_id = meta_data_tmp['scan_param_id']
-    chunk_start_time = meta_data_tmp['timestamp_start']
-    discarded_packages = 0
+    if parallel:
+        write_chunks(h5_filename_out, pix_data, pool, tasks, hits_filename)
 
-    # Get the chunks and the indices of data packages after chunks with errors
-    chunks_after_errors = np.where(errors != 0)[0] + 1
-    if len(chunks_after_errors) > 0:
-        if chunks_after_errors[-1] > (len(indices) - 1):
-            chunks_after_errors = chunks_after_errors[:-1]
-        #indices_after_errors = indices[chunks_after_errors]
-    
-    print("Correct data")
-    
-    i = 0
-    previous_move_to_next_chunk = []
-    for chunk_indices in tqdm(indices, desc="Chunk"):
-        # For chunks with errors do noting as they are anyway discarded
-        if errors[i] != 0:
-            i += 1
-            continue
-        # Ignore chunks without data
-        if len(chunk_indices) == 0:
-            i += 1
-            continue
-        # Based on the headers, filter for hit words and create a list of these words and a list of their indices
+def save_progress(h5_filename_out, progress, attributes, decode_stats=None):
+    # Record a completed slice in the progress table of the output file, so that an
+    # interrupted interpretation can be resumed after the last completed slice.
+    # The decode statistics of the slice are stored in the decode_stats table
+    with tb.open_file(h5_filename_out, 'a') as h5_file_out:
+        if decode_stats is not None:
+            try:
+                stats_table = h5_file_out.root.interpreted.decode_stats
+            except tb.NoSuchNodeError:
+                stats_table = h5_file_out.create_table(h5_file_out.root.interpreted, 'decode_stats', np.zeros(0, dtype=decode_stats_type), 'Decode statistics')
+            stats_table.append(decode_stats)
+            stats_table.flush()
         try:
-            current_raw_data = h5_file_in.root.raw_data[chunk_indices]
-        except:
-            print('Corrupted chunk')
-            errors[i] += 1
-            continue
-        hit_filter = np.where(np.right_shift(np.bitwise_and(current_raw_data, 0xf0000000), 28) != 0b0101)
-        hits = current_raw_data[hit_filter]
-        hits_indices = chunk_indices[hit_filter]
-        hit_filter = None
-
-        # Only in "DataTake" the ToA extensions are active
-        if scan_id == 'DataTake':
-            # Based on the headers, filter for ToA extension words and create a list of these words and a list of their indices
-            timestamp_map = np.right_shift(np.bitwise_and(current_raw_data, 0xf0000000), 28) == 0b0101
-            timestamp_filter = np.where(timestamp_map == True)
-            timestamps = current_raw_data[timestamp_filter]
-            timestamps_indices = chunk_indices[timestamp_filter]
-
-            # Split the lists in separate lists for word 0 and word 1 (based on header)
-            timestamps_0_filter = np.where(np.right_shift(np.bitwise_and(timestamps, 0x3000000), 24) == 0b01)[0]
-            timestamps_1_filter = np.where(np.right_shift(np.bitwise_and(timestamps, 0x3000000), 24) == 0b10)[0]
-            timestamps = None
-            timestamp_filter = None
-        current_raw_data = None
-
-        # Split the hit word list up into lists of words for the individual chip links
-        # First: create the filer for this
-        link0_hits_filter = np.where(np.right_shift(np.bitwise_and(hits, 0xfe000000), 24) == 0b00000000)
-        link1_hits_filter = np.where(np.right_shift(np.bitwise_and(hits, 0xfe000000), 24) == 0b00000010)
-        link2_hits_filter = np.where(np.right_shift(np.bitwise_and(hits, 0xfe000000), 24) == 0b00000100)
-        link3_hits_filter = np.where(np.right_shift(np.bitwise_and(hits, 0xfe000000), 24) == 0b00000110)
-        link4_hits_filter = np.where(np.right_shift(np.bitwise_and(hits, 0xfe000000), 24) == 0b00001000)
-        link5_hits_filter = np.where(np.right_shift(np.bitwise_and(hits, 0xfe000000), 24) == 0b00001010)
-        link6_hits_filter = np.where(np.right_shift(np.bitwise_and(hits, 0xfe000000), 24) == 0b00001100)
-        link7_hits_filter = np.where(np.right_shift(np.bitwise_and(hits, 0xfe000000), 24) == 0b00001110)
-
-        # Second: Filter the words
-        link0_words = hits[link0_hits_filter]
-        link1_words = hits[link1_hits_filter]
-        link2_words = hits[link2_hits_filter]
-        link3_words = hits[link3_hits_filter]
-        link4_words = hits[link4_hits_filter]
-        link5_words = hits[link5_hits_filter]
-        link6_words = hits[link6_hits_filter]
-        link7_words = hits[link7_hits_filter]
-
-        # Third: Apply the filter also to the indices
-        link0_words_indices = hits_indices[link0_hits_filter]
-        link1_words_indices = hits_indices[link1_hits_filter]
-        link2_words_indices = hits_indices[link2_hits_filter]
-        link3_words_indices = hits_indices[link3_hits_filter]
-        link4_words_indices = hits_indices[link4_hits_filter]
-        link5_words_indices = hits_indices[link5_hits_filter]
-        link6_words_indices = hits_indices[link6_hits_filter]
-        link7_words_indices = hits_indices[link7_hits_filter]
-        hits = None
-        hits_indices = None
-
-        # Split the hit list for the links up into separate lists with word 0 and word 1
-        # First: create the filter
-        link0_words0_filter = np.where(np.right_shift(np.bitwise_and(link0_words, 0x1000000), 24) == 0b0)[0]
-        link0_words1_filter = np.where(np.right_shift(np.bitwise_and(link0_words, 0x1000000), 24) == 0b1)[0]
-        link1_words0_filter = np.where(np.right_shift(np.bitwise_and(link1_words, 0x1000000), 24) == 0b0)[0]
-        link1_words1_filter = np.where(np.right_shift(np.bitwise_and(link1_words, 0x1000000), 24) == 0b1)[0]
-        link2_words0_filter = np.where(np.right_shift(np.bitwise_and(link2_words, 0x1000000), 24) == 0b0)[0]
-        link2_words1_filter = np.where(np.right_shift(np.bitwise_and(link2_words, 0x1000000), 24) == 0b1)[0]
-        link3_words0_filter = np.where(np.right_shift(np.bitwise_and(link3_words, 0x1000000), 24) == 0b0)[0]
-        link3_words1_filter = np.where(np.right_shift(np.bitwise_and(link3_words, 0x1000000), 24) == 0b1)[0]
-        link4_words0_filter = np.where(np.right_shift(np.bitwise_and(link4_words, 0x1000000), 24) == 0b0)[0]
-        link4_words1_filter = np.where(np.right_shift(np.bitwise_and(link4_words, 0x1000000), 24) == 0b1)[0]
-        link5_words0_filter = np.where(np.right_shift(np.bitwise_and(link5_words, 0x1000000), 24) == 0b0)[0]
-        link5_words1_filter = np.where(np.right_shift(np.bitwise_and(link5_words, 0x1000000), 24) == 0b1)[0]
-        link6_words0_filter = np.where(np.right_shift(np.bitwise_and(link6_words, 0x1000000), 24) == 0b0)[0]
-        link6_words1_filter = np.where(np.right_shift(np.bitwise_and(link6_words, 0x1000000), 24) == 0b1)[0]
-        link7_words0_filter = np.where(np.right_shift(np.bitwise_and(link7_words, 0x1000000), 24) == 0b0)[0]
-        link7_words1_filter = np.where(np.right_shift(np.bitwise_and(link7_words, 0x1000000), 24) == 0b1)[0]
-
-        copy_to_next_chunk = []
-        move_to_next_chunk = []
-        removed_indices = []
-
-        # If a current chunk is after a chunk with errors remove the first word per link if its the wrong one (word 0 instead of 1)
-        if i in chunks_after_errors:
-            if scan_id == 'DataTake':
-                if timestamps_0_filter[0] < timestamps_1_filter[0]:
-                    removed_indices.append(timestamps_indices[0])
-            if len(link0_words_indices) > 1:
-                if link0_words0_filter[0] < link0_words1_filter[0]:
-                    removed_indices.append(link0_words_indices[0])
-            elif len(link0_words_indices) > 0:
-                removed_indices.append(link0_words_indices[0])
-            if len(link1_words_indices) > 1:
-                if link1_words0_filter[0] < link1_words1_filter[0]:
-                    removed_indices.append(link1_words_indices[0])
-            elif len(link1_words_indices) > 0:
-                removed_indices.append(link1_words_indices[0])
-            if len(link2_words_indices) > 1:
-                if link2_words0_filter[0] < link2_words1_filter[0]:
-                    removed_indices.append(link2_words_indices[0])
-            elif len(link2_words_indices) > 0:
-                removed_indices.append(link2_words_indices[0])
-            if len(link3_words_indices) > 1:
-                if link3_words0_filter[0] < link3_words1_filter[0]:
-                    removed_indices.append(link3_words_indices[0])
-            elif len(link3_words_indices) > 0:
-                removed_indices.append(link3_words_indices[0])
-            if len(link4_words_indices) > 1:
-                if link4_words0_filter[0] < link4_words1_filter[0]:
-                    removed_indices.append(link4_words_indices[0])
-            elif len(link4_words_indices) > 0:
-                removed_indices.append(link4_words_indices[0])
-            if len(link5_words_indices) > 1:
-                if link5_words0_filter[0] < link5_words1_filter[0]:
-                    removed_indices.append(link5_words_indices[0])
-            elif len(link5_words_indices) > 0:
-                removed_indices.append(link5_words_indices[0])
-            if len(link6_words_indices) > 1:
-                if link6_words0_filter[0] < link6_words1_filter[0]:
-                    removed_indices.append(link6_words_indices[0])
-            elif len(link6_words_indices) > 0:
-                removed_indices.append(link6_words_indices[0])
-            if len(link7_words_indices) > 1:
-                if link7_words0_filter[0] < link7_words1_filter[0]:
-                    removed_indices.append(link7_words_indices[0])
-            elif len(link7_words_indices) > 0:
-                removed_indices.append(link7_words_indices[0])
-
-        if i + 1 < len(indices):
-            # If the difference of 0 and 1 packages is bigger than 0 remove the chunk as there is some error
-            if np.abs(len(link0_words0_filter) - len(link0_words1_filter)) > 1:
-                errors[i] += 1
-                chunks_after_errors = np.append(chunks_after_errors, i+1)
-                i += 1
-                continue
-            if np.abs(len(link1_words0_filter) - len(link1_words1_filter)) > 1:
-                errors[i] += 1
-                chunks_after_errors = np.append(chunks_after_errors, i+1)
-                i += 1
-                continue
-            if np.abs(len(link2_words0_filter) - len(link2_words1_filter)) > 1:
-                errors[i] += 1
-                chunks_after_errors = np.append(chunks_after_errors, i+1)
-                i += 1
-                continue
-            if np.abs(len(link3_words0_filter) - len(link3_words1_filter)) > 1:
-                errors[i] += 1
-                chunks_after_errors = np.append(chunks_after_errors, i+1)
-                i += 1
-                continue
-            if np.abs(len(link4_words0_filter) - len(link4_words1_filter)) > 1:
-                errors[i] += 1
-                chunks_after_errors = np.append(chunks_after_errors, i+1)
-                i += 1
-                continue
-            if np.abs(len(link5_words0_filter) - len(link5_words1_filter)) > 1:
-                errors[i] += 1
-                chunks_after_errors = np.append(chunks_after_errors, i+1)
-                i += 1
-                continue
-            if np.abs(len(link6_words0_filter) - len(link6_words1_filter)) > 1:
-                errors[i] += 1
-                chunks_after_errors = np.append(chunks_after_errors, i+1)
-                i += 1
-                continue
-            if np.abs(len(link7_words0_filter) - len(link7_words1_filter)) > 1:
-                errors[i] += 1
-                chunks_after_errors = np.append(chunks_after_errors, i+1)
-                i += 1
-                continue
-
-        # If the chunk (per link) ends with a word 1 without fitting word 0 move the word 1 to the next chunk
+            table = h5_file_out.root.interpreted.progress
+        except tb.NoSuchNodeError:
+            table = h5_file_out.create_table(h5_file_out.root.interpreted, 'progress', np.zeros(0, dtype=progress_type), 'Interpretation progress')
+            for name, value in attributes.items():
+                table.attrs[name] = value
+        table.append(progress)
+        table.flush()
+
+def load_progress(h5_filename_out, attributes):
+    # Read the completed slices from the progress table of the output file. Returns None
+    # if the output file does not contain a valid state to resume from
+    if not os.path.exists(h5_filename_out):
+        print("Output file", h5_filename_out, "does not exist - nothing to resume")
+        return None
+    try:
+        h5_file_out = tb.open_file(h5_filename_out, 'a')
+    except (IOError, OSError):
+        print("Output file", h5_filename_out, "can not be opened - nothing to resume")
+        return None
+    with h5_file_out:
+        try:
+            table = h5_file_out.root.interpreted.progress
+            hit_data = h5_file_out.root.interpreted.run_0.hit_data
+        except tb.NoSuchNodeError:
+            print("Output file contains no progress information - nothing to resume")
+            return None
+
+        # The output has to be created from the same input with the same settings
+        for name, value in attributes.items():
+            if name not in table.attrs or not np.array_equal(table.attrs[name], value):
+                print("Progress information does not match the current run (" + name + ") - can not resume")
+                return None
+
+        progress = table[:]
+        if len(progress) == 0:
+            print("Output file contains no completed slices - nothing to resume")
+            return None
+        # The slices of a selection are not contiguous, they are compared with the planned slices in run()
+        if np.any(progress['slice_start'] >= progress['slice_stop']) or np.any(np.cumsum(progress['hits']) != progress['total_hits']):
+            print("Progress information is inconsistent - can not resume")
+            return None
+
+        # Hits of a slice that was written but not recorded as completed are removed again
+        total_hits = int(progress['total_hits'][-1])
+        if hit_data.nrows < total_hits:
+            print("Output file contains less hits than recorded (" + str(hit_data.nrows) + " of " + str(total_hits) + ") - can not resume")
+            return None
+        if hit_data.nrows > total_hits:
+            print("Remove", hit_data.nrows - total_hits, "hits of an incomplete slice")
+            hit_data.truncate(total_hits)
+            hit_data.flush()
+
+        # The same for the decode statistics of the incomplete slice
+        if '/interpreted/decode_stats' in h5_file_out and h5_file_out.root.interpreted.decode_stats.nrows > len(progress):
+            h5_file_out.root.interpreted.decode_stats.truncate(len(progress))
+
+    return progress
+
+class FrameBuilder:
+    # Builds frames of 256x256 pixels from a stream of hits, with the number of hits ('counts') or the summed
+    # ToT ('tot') per pixel in fixed windows of TOA_Combined (1 ms = 40000). The frames are stored in
+    # interpreted/frames as frames[i, y, x] ordered by window and their windows in interpreted/frame_index,
+    # windows without hits are skipped. At most frame_open_max frames are kept open: windows before the first
+    # window of the added hits are written, and if there are too many open windows the oldest are written.
+    # Hits of a window that is already written are added to the written frame, so the frames do not depend
+    # on the order of the hits (e.g. outliers in TOA_Combined, the slicing or a resumed interpretation)
+    def __init__(self, h5_filename_out, window, mode='counts', time_range=None):
+        if mode not in ['counts', 'tot']:
+            raise ValueError("Unknown frame mode " + str(mode))
+        self.h5_filename_out = h5_filename_out
+        self.window = int(window)
+        self.mode = mode
+        self.time_range = time_range
+        self.open_frames = {}
+        self.written = {}
+        self.last_window = None
+        self.unordered = False
+        self.created = False
+
+    def add(self, pix_data):
+        # Add the hits in blocks of frame_block_hits hits, so that the memory does not grow with the slice
+        for start in range(0, len(pix_data), frame_block_hits):
+            self.add_block(pix_data[start:start + frame_block_hits])
+
+    def add_block(self, pix_data):
+        toa = pix_data['TOA_Combined']
+        selection = np.ones(len(toa), dtype=bool)
+        if self.time_range is not None:
+            selection &= (toa >= self.time_range[0]) & (toa < self.time_range[1])
+        if not np.any(selection):
+            return
+        frame_windows, frame_hits = np.unique(toa[selection] // np.uint64(self.window), return_inverse=True)
+        pixels = pix_data['y'][selection].astype(np.int64) * 256 + pix_data['x'][selection]
+        weights = pix_data['TOT'][selection] if self.mode == 'tot' else None
+
+        # Bin the hits of frame_batch frames at once, the hits are ordered by their frame
+        order = np.argsort(frame_hits, kind='stable')
+        frame_hits = frame_hits[order]
+        pixels = pixels[order]
+        if weights is not None:
+            weights = weights[order]
+        for start in range(0, len(frame_windows), frame_batch):
+            stop = min(start + frame_batch, len(frame_windows))
+            first, last = np.searchsorted(frame_hits, [start, stop])
+            frames = np.bincount((frame_hits[first:last] - start) * 65536 + pixels[first:last],
+                                 weights=None if weights is None else weights[first:last], minlength=(stop - start) * 65536)
+            frames = frames.astype(np.uint32).reshape(stop - start, 256, 256)
+            hits = np.bincount(frame_hits[first:last] - start, minlength=stop - start)
+
+            written = []
+            for i, window in enumerate(frame_windows[start:stop].tolist()):
+                if window in self.written:
+                    written.append(i)
+                elif window in self.open_frames:
+                    self.open_frames[window][0] += frames[i]
+                    self.open_frames[window][1] += int(hits[i])
+                else:
+                    self.open_frames[window] = [frames[i].copy(), int(hits[i])]
+            if len(written) > 0:
+                self.write_frames(frame_windows[start:stop][written], frames[written], hits[written])
+            if len(self.open_frames) > frame_open_max:
+                self.write_open_frames(sorted(self.open_frames)[:len(self.open_frames) - frame_open_max // 2])
+
+        # Windows before the added hits are complete, unless hits arrive out of order
+        self.write_open_frames([window for window in self.open_frames if window < int(frame_windows[0])])
+
+    def add_file(self, h5_filename):
+        # Add the hits of an output file, read in blocks of frame_block_hits hits
+        with tb.open_file(h5_filename, 'r') as h5_file:
+            nrows = h5_file.root.interpreted.run_0.hit_data.nrows
+        for start in tqdm(range(0, nrows, frame_block_hits), desc="Hits"):
+            with tb.open_file(h5_filename, 'r') as h5_file:
+                pix_data = h5_file.root.interpreted.run_0.hit_data[start:start + frame_block_hits]
+            self.add(pix_data)
+
+    def write_open_frames(self, windows):
+        if len(windows) == 0:
+            return
+        windows = sorted(windows)
+        frames = np.stack([self.open_frames[window][0] for window in windows])
+        hits = np.array([self.open_frames[window][1] for window in windows])
+        for window in windows:
+            del self.open_frames[window]
+        self.write_frames(np.array(windows, dtype=np.uint64), frames, hits)
+
+    def write_frames(self, windows, frames, hits):
+        # Append the frames of new windows and add the frames of written windows to the stored frames
+        with tb.open_file(self.h5_filename_out, 'a') as h5_file_out:
+            # Frames of an earlier interpretation are replaced
+            if not self.created:
+                if '/interpreted' not in h5_file_out:
+                    h5_file_out.create_group(h5_file_out.root, 'interpreted', 'interpreted')
+                for name in ['frames', 'frame_index']:
+                    if name in h5_file_out.root.interpreted:
+                        h5_file_out.remove_node(h5_file_out.root.interpreted, name)
+                self.create_frames(h5_file_out, 'frames')
+                h5_file_out.create_table(h5_file_out.root.interpreted, 'frame_index', np.zeros(0, dtype=frame_index_type), 'Frame index')
+                self.created = True
+            frames_array = h5_file_out.root.interpreted.frames
+            frame_index_table = h5_file_out.root.interpreted.frame_index
+            new = np.array([int(window) not in self.written for window in windows], dtype=bool)
+            for i in np.where(~new)[0]:
+                row = self.written[int(windows[i])]
+                frames_array[row] = frames_array[row] + frames[i]
+                frame_index_table.cols.hits[row] = int(frame_index_table.cols.hits[row]) + int(hits[i])
+            if np.any(new):
+                if self.last_window is not None and int(windows[new][0]) < self.last_window:
+                    self.unordered = True
+                for window in windows[new].tolist():
+                    self.written[window] = len(self.written)
+                self.last_window = max(int(np.max(windows[new])), self.last_window if self.last_window is not None else 0)
+                frames_array.append(frames[new])
+                frame_index = np.zeros(np.count_nonzero(new), dtype=frame_index_type)
+                frame_index['window'] = windows[new]
+                frame_index['toa_start'] = windows[new] * np.uint64(self.window)
+                frame_index['hits'] = hits[new]
+                frame_index_table.append(frame_index)
+            frame_index_table.flush()
+
+    def create_frames(self, h5_file_out, name):
+        frames_array = h5_file_out.create_earray(h5_file_out.root.interpreted, name, tb.UInt32Atom(), shape=(0, 256, 256), title='Frames',
+                                                 filters=tb.Filters(complib='zlib', complevel=2), chunkshape=(1, 256, 256))
+        frames_array.attrs['window'] = self.window
+        frames_array.attrs['mode'] = self.mode
+        frames_array.attrs['time_range'] = str(self.time_range)
+        return frames_array
+
+    def sort_frames(self):
+        # Order the frames by window, if frames of earlier windows were written after later windows
+        with tb.open_file(self.h5_filename_out, 'a') as h5_file_out:
+            frames_array = h5_file_out.root.interpreted.frames
+            frame_index = h5_file_out.root.interpreted.frame_index[:]
+            order = np.argsort(frame_index['window'])
+            sorted_frames = self.create_frames(h5_file_out, 'frames_sorted')
+            for start in range(0, len(order), frame_batch):
+                sorted_frames.append(np.stack([frames_array[row] for row in order[start:start + frame_batch]]))
+            h5_file_out.remove_node(h5_file_out.root.interpreted, 'frames')
+            h5_file_out.rename_node(h5_file_out.root.interpreted, 'frames', 'frames_sorted')
+            h5_file_out.remove_node(h5_file_out.root.interpreted, 'frame_index')
+            h5_file_out.create_table(h5_file_out.root.interpreted, 'frame_index', frame_index[order], 'Frame index')
+        self.written = {int(window): row for row, window in enumerate(frame_index['window'][order])}
+        self.unordered = False
+
+    def close(self):
+        # Write the open frames and return the number of frames
+        self.write_open_frames(list(self.open_frames))
+        if not self.created:
+            self.write_frames(np.zeros(0, dtype=np.uint64), np.zeros((0, 256, 256), dtype=np.uint32), np.zeros(0, dtype=np.uint64))
+        if self.unordered:
+            self.sort_frames()
+        return len(self.written)
+
+def build_frames(h5_filename_in, h5_filename_out, window, mode='counts', time_range=None):
+    # Build the frames from the hits of an existing output file
+    frame_builder = FrameBuilder(h5_filename_out, window, mode, time_range)
+    frame_builder.add_file(h5_filename_in)
+    return frame_builder.close()
+
+def correct_chunk(raw_data, scan_id, chunk_indices, after_error, previous_move_to_next_chunk, next_chunk):
+    # Correct a chunk that follows a chunk with errors (after_error) or got the words previous_move_to_next_chunk
+    # moved from the previous chunk. Returns the new indices of the chunk, 1 if the chunk has errors,
+    # the number of removed packages and the state for the next chunk: if it follows a chunk with errors
+    # and the words that are moved and copied to it
+    no_indices = np.zeros(0, dtype=int)
+    # Based on the headers, filter for hit words and create a list of these words and a list of their indices
+    try:
+        current_raw_data = raw_data.read(chunk_indices)
+    except:
+        print('Corrupted chunk')
+        return chunk_indices, 1, 0, (True, no_indices, no_indices)
+    hit_filter = np.where(np.right_shift(np.bitwise_and(current_raw_data, 0xf0000000), 28) != 0b0101)
+    hits = current_raw_data[hit_filter]
+    hits_indices = chunk_indices[hit_filter]
+    hit_filter = None
+
+    # Only in "DataTake" the ToA extensions are active
+    if scan_id == 'DataTake':
+        # Based on the headers, filter for ToA extension words and create a list of these words and a list of their indices
+        timestamp_map = np.right_shift(np.bitwise_and(current_raw_data, 0xf0000000), 28) == 0b0101
+        timestamp_filter = np.where(timestamp_map == True)
+        timestamps = current_raw_data[timestamp_filter]
+        timestamps_indices = chunk_indices[timestamp_filter]
+
+        # Split the lists in separate lists for word 0 and word 1 (based on header)
+        timestamps_0_filter = np.where(np.right_shift(np.bitwise_and(timestamps, 0x3000000), 24) == 0b01)[0]
+        timestamps_1_filter = np.where(np.right_shift(np.bitwise_and(timestamps, 0x3000000), 24) == 0b10)[0]
+        timestamps = None
+        timestamp_filter = None
+    current_raw_data = None
+
+    # Split the hit word list up into lists of words for the individual chip links
+    # First: create the filer for this
+    link0_hits_filter = np.where(np.right_shift(np.bitwise_and(hits, 0xfe000000), 24) == 0b00000000)
+    link1_hits_filter = np.where(np.right_shift(np.bitwise_and(hits, 0xfe000000), 24) == 0b00000010)
+    link2_hits_filter = np.where(np.right_shift(np.bitwise_and(hits, 0xfe000000), 24) == 0b00000100)
+    link3_hits_filter = np.where(np.right_shift(np.bitwise_and(hits, 0xfe000000), 24) == 0b00000110)
+    link4_hits_filter = np.where(np.right_shift(np.bitwise_and(hits, 0xfe000000), 24) == 0b00001000)
+    link5_hits_filter = np.where(np.right_shift(np.bitwise_and(hits, 0xfe000000), 24) == 0b00001010)
+    link6_hits_filter = np.where(np.right_shift(np.bitwise_and(hits, 0xfe000000), 24) == 0b00001100)
+    link7_hits_filter = np.where(np.right_shift(np.bitwise_and(hits, 0xfe000000), 24) == 0b00001110)
+
+    # Second: Filter the words
+    link0_words = hits[link0_hits_filter]
+    link1_words = hits[link1_hits_filter]
+    link2_words = hits[link2_hits_filter]
+    link3_words = hits[link3_hits_filter]
+    link4_words = hits[link4_hits_filter]
+    link5_words = hits[link5_hits_filter]
+    link6_words = hits[link6_hits_filter]
+    link7_words = hits[link7_hits_filter]
+
+    # Third: Apply the filter also to the indices
+    link0_words_indices = hits_indices[link0_hits_filter]
+    link1_words_indices = hits_indices[link1_hits_filter]
+    link2_words_indices = hits_indices[link2_hits_filter]
+    link3_words_indices = hits_indices[link3_hits_filter]
+    link4_words_indices = hits_indices[link4_hits_filter]
+    link5_words_indices = hits_indices[link5_hits_filter]
+    link6_words_indices = hits_indices[link6_hits_filter]
+    link7_words_indices = hits_indices[link7_hits_filter]
+    hits = None
+    hits_indices = None
+
+    # Split the hit list for the links up into separate lists with word 0 and word 1
+    # First: create the filter
+    link0_words0_filter = np.where(np.right_shift(np.bitwise_and(link0_words, 0x1000000), 24) == 0b0)[0]
+    link0_words1_filter = np.where(np.right_shift(np.bitwise_and(link0_words, 0x1000000), 24) == 0b1)[0]
+    link1_words0_filter = np.where(np.right_shift(np.bitwise_and(link1_words, 0x1000000), 24) == 0b0)[0]
+    link1_words1_filter = np.where(np.right_shift(np.bitwise_and(link1_words, 0x1000000), 24) == 0b1)[0]
+    link2_words0_filter = np.where(np.right_shift(np.bitwise_and(link2_words, 0x1000000), 24) == 0b0)[0]
+    link2_words1_filter = np.where(np.right_shift(np.bitwise_and(link2_words, 0x1000000), 24) == 0b1)[0]
+    link3_words0_filter = np.where(np.right_shift(np.bitwise_and(link3_words, 0x1000000), 24) == 0b0)[0]
+    link3_words1_filter = np.where(np.right_shift(np.bitwise_and(link3_words, 0x1000000), 24) == 0b1)[0]
+    link4_words0_filter = np.where(np.right_shift(np.bitwise_and(link4_words, 0x1000000), 24) == 0b0)[0]
+    link4_words1_filter = np.where(np.right_shift(np.bitwise_and(link4_words, 0x1000000), 24) == 0b1)[0]
+    link5_words0_filter = np.where(np.right_shift(np.bitwise_and(link5_words, 0x1000000), 24) == 0b0)[0]
+    link5_words1_filter = np.where(np.right_shift(np.bitwise_and(link5_words, 0x1000000), 24) == 0b1)[0]
+    link6_words0_filter = np.where(np.right_shift(np.bitwise_and(link6_words, 0x1000000), 24) == 0b0)[0]
+    link6_words1_filter = np.where(np.right_shift(np.bitwise_and(link6_words, 0x1000000), 24) == 0b1)[0]
+    link7_words0_filter = np.where(np.right_shift(np.bitwise_and(link7_words, 0x1000000), 24) == 0b0)[0]
+    link7_words1_filter = np.where(np.right_shift(np.bitwise_and(link7_words, 0x1000000), 24) == 0b1)[0]
+
+    copy_to_next_chunk = []
+    move_to_next_chunk = []
+    removed_indices = []
+
+    # If a current chunk is after a chunk with errors remove the first word per link if its the wrong one (word 0 instead of 1)
+    if after_error:
         if scan_id == 'DataTake':
-            if timestamps_0_filter[-1] < timestamps_1_filter[-1]:
-                move_to_next_chunk.append(timestamps_indices[-1])
-                copy_to_next_chunk.append(timestamps_indices[-3:-1])
-            else:
-                copy_to_next_chunk.append(timestamps_indices[-2:])
+            if timestamps_0_filter[0] < timestamps_1_filter[0]:
+                removed_indices.append(timestamps_indices[0])
         if len(link0_words_indices) > 1:
-            if link0_words0_filter[-1] < link0_words1_filter[-1]:
-                move_to_next_chunk.append(link0_words_indices[-1])
+            if link0_words0_filter[0] < link0_words1_filter[0]:
+                removed_indices.append(link0_words_indices[0])
         elif len(link0_words_indices) > 0:
-            move_to_next_chunk.append(link0_words_indices[-1])
+            removed_indices.append(link0_words_indices[0])
         if len(link1_words_indices) > 1:
-            if link1_words0_filter[-1] < link1_words1_filter[-1]:
-                move_to_next_chunk.append(link1_words_indices[-1])
+            if link1_words0_filter[0] < link1_words1_filter[0]:
+                removed_indices.append(link1_words_indices[0])
         elif len(link1_words_indices) > 0:
-            move_to_next_chunk.append(link1_words_indices[-1])
+            removed_indices.append(link1_words_indices[0])
         if len(link2_words_indices) > 1:
-            if link2_words0_filter[-1] < link2_words1_filter[-1]:
-                move_to_next_chunk.append(link2_words_indices[-1])
+            if link2_words0_filter[0] < link2_words1_filter[0]:
+                removed_indices.append(link2_words_indices[0])
         elif len(link2_words_indices) > 0:
-            move_to_next_chunk.append(link2_words_indices[-1])
+            removed_indices.append(link2_words_indices[0])
         if len(link3_words_indices) > 1:
-            if link3_words0_filter[-1] < link3_words1_filter[-1]:
-                move_to_next_chunk.append(link3_words_indices[-1])
+            if link3_words0_filter[0] < link3_words1_filter[0]:
+                removed_indices.append(link3_words_indices[0])
         elif len(link3_words_indices) > 0:
-            move_to_next_chunk.append(link3_words_indices[-1])
+            removed_indices.append(link3_words_indices[0])
         if len(link4_words_indices) > 1:
-            if link4_words0_filter[-1] < link4_words1_filter[-1]:
-                move_to_next_chunk.append(link4_words_indices[-1])
+            if link4_words0_filter[0] < link4_words1_filter[0]:
+                removed_indices.append(link4_words_indices[0])
         elif len(link4_words_indices) > 0:
-            move_to_next_chunk.append(link4_words_indices[-1])
+            removed_indices.append(link4_words_indices[0])
         if len(link5_words_indices) > 1:
-            if link5_words0_filter[-1] < link5_words1_filter[-1]:
-                move_to_next_chunk.append(link5_words_indices[-1])
+            if link5_words0_filter[0] < link5_words1_filter[0]:
+                removed_indices.append(link5_words_indices[0])
         elif len(link5_words_indices) > 0:
-            move_to_next_chunk.append(link5_words_indices[-1])
+            removed_indices.append(link5_words_indices[0])
         if len(link6_words_indices) > 1:
-            if link6_words0_filter[-1] < link6_words1_filter[-1]:
-                move_to_next_chunk.append(link6_words_indices[-1])
+            if link6_words0_filter[0] < link6_words1_filter[0]:
+                removed_indices.append(link6_words_indices[0])
         elif len(link6_words_indices) > 0:
-            move_to_next_chunk.append(link6_words_indices[-1])
+            removed_indices.append(link6_words_indices[0])
         if len(link7_words_indices) > 1:
-            if link7_words0_filter[-1] < link7_words1_filter[-1]:
-                move_to_next_chunk.append(link7_words_indices[-1])
+            if link7_words0_filter[0] < link7_words1_filter[0]:
+                removed_indices.append(link7_words_indices[0])
         elif len(link7_words_indices) > 0:
+            removed_indices.append(link7_words_indices[0])
+
+    if next_chunk:
+        # If the difference of 0 and 1 packages is bigger than 0 remove the chunk as there is some error
+        if np.abs(len(link0_words0_filter) - len(link0_words1_filter)) > 1:
+            return chunk_indices, 1, 0, (True, no_indices, no_indices)
+        if np.abs(len(link1_words0_filter) - len(link1_words1_filter)) > 1:
+            return chunk_indices, 1, 0, (True, no_indices, no_indices)
+        if np.abs(len(link2_words0_filter) - len(link2_words1_filter)) > 1:
+            return chunk_indices, 1, 0, (True, no_indices, no_indices)
+        if np.abs(len(link3_words0_filter) - len(link3_words1_filter)) > 1:
+            return chunk_indices, 1, 0, (True, no_indices, no_indices)
+        if np.abs(len(link4_words0_filter) - len(link4_words1_filter)) > 1:
+            return chunk_indices, 1, 0, (True, no_indices, no_indices)
+        if np.abs(len(link5_words0_filter) - len(link5_words1_filter)) > 1:
+            return chunk_indices, 1, 0, (True, no_indices, no_indices)
+        if np.abs(len(link6_words0_filter) - len(link6_words1_filter)) > 1:
+            return chunk_indices, 1, 0, (True, no_indices, no_indices)
+        if np.abs(len(link7_words0_filter) - len(link7_words1_filter)) > 1:
+            return chunk_indices, 1, 0, (True, no_indices, no_indices)
+
+    # If the chunk (per link) ends with a word 1 without fitting word 0 move the word 1 to the next chunk
+    if scan_id == 'DataTake':
+        if timestamps_0_filter[-1] < timestamps_1_filter[-1]:
+            move_to_next_chunk.append(timestamps_indices[-1])
+            copy_to_next_chunk.append(timestamps_indices[-3:-1])
+        else:
+            copy_to_next_chunk.append(timestamps_indices[-2:])
+    if len(link0_words_indices) > 1:
+        if link0_words0_filter[-1] < link0_words1_filter[-1]:
+            move_to_next_chunk.append(link0_words_indices[-1])
+    elif len(link0_words_indices) > 0:
+        move_to_next_chunk.append(link0_words_indices[-1])
+    if len(link1_words_indices) > 1:
+        if link1_words0_filter[-1] < link1_words1_filter[-1]:
+            move_to_next_chunk.append(link1_words_indices[-1])
+    elif len(link1_words_indices) > 0:
+        move_to_next_chunk.append(link1_words_indices[-1])
+    if len(link2_words_indices) > 1:
+        if link2_words0_filter[-1] < link2_words1_filter[-1]:
+            move_to_next_chunk.append(link2_words_indices[-1])
+    elif len(link2_words_indices) > 0:
+        move_to_next_chunk.append(link2_words_indices[-1])
+    if len(link3_words_indices) > 1:
+        if link3_words0_filter[-1] < link3_words1_filter[-1]:
+            move_to_next_chunk.append(link3_words_indices[-1])
+    elif len(link3_words_indices) > 0:
+        move_to_next_chunk.append(link3_words_indices[-1])
+    if len(link4_words_indices) > 1:
+        if link4_words0_filter[-1] < link4_words1_filter[-1]:
+            move_to_next_chunk.append(link4_words_indices[-1])
+    elif len(link4_words_indices) > 0:
+        move_to_next_chunk.append(link4_words_indices[-1])
+    if len(link5_words_indices) > 1:
+        if link5_words0_filter[-1] < link5_words1_filter[-1]:
+            move_to_next_chunk.append(link5_words_indices[-1])
+    elif len(link5_words_indices) > 0:
+        move_to_next_chunk.append(link5_words_indices[-1])
+    if len(link6_words_indices) > 1:
+        if link6_words0_filter[-1] < link6_words1_filter[-1]:
+            move_to_next_chunk.append(link6_words_indices[-1])
+    elif len(link6_words_indices) > 0:
+        move_to_next_chunk.append(link6_words_indices[-1])
+    if len(link7_words_indices) > 1:
+        if link7_words0_filter[-1] < link7_words1_filter[-1]:
             move_to_next_chunk.append(link7_words_indices[-1])
+    elif len(link7_words_indices) > 0:
+        move_to_next_chunk.append(link7_words_indices[-1])
+
+    # Move only packages to the next chunk that were not already moved to the current chunk
+    move_to_next_chunk = np.setdiff1d(move_to_next_chunk, previous_move_to_next_chunk)
+
+    # Create the new indice list for the current chunk, the next chunk gets the moved and copied words
+    new_indices = chunk_indices
+    removed_packages = 0
+    if len(removed_indices) > 0:
+        new_indices = np.setdiff1d(new_indices, removed_indices)
+        removed_packages = len(removed_indices)
+    if next_chunk and len(move_to_next_chunk) > 0:
+        new_indices = np.setdiff1d(new_indices, move_to_next_chunk)
+    else:
+        move_to_next_chunk = no_indices
+    if next_chunk and len(copy_to_next_chunk) > 0:
+        copy_to_next_chunk = np.concatenate(copy_to_next_chunk)
+    else:
+        copy_to_next_chunk = no_indices
+    return new_indices, 0, removed_packages, (False, move_to_next_chunk, copy_to_next_chunk)
+
+def correct_chunks(raw_data, scan_id, start_indices, stop_indices, errors, state, last_chunk, progress=False):
+    # Correct consecutive chunks, starting with the state after the previous chunk. The last chunk
+    # only moves words to the next chunk if it is not the last chunk of the slice (last_chunk)
+    # Returns the new indices, errors and removed packages of the chunks and the state after each chunk
+    no_indices = np.zeros(0, dtype=int)
+    errors = np.array(errors)
+    indices = np.empty(len(start_indices), dtype=object)
+    indices[:] = [np.arange(start, stop, 1, dtype=int) for start, stop in zip(start_indices, stop_indices)]
+    removed_packages = np.zeros(len(indices), dtype=np.int64)
+    states = []
+
+    for i in tqdm(range(len(indices)), desc="Chunk", disable=not progress):
+        # Add the words that are moved and copied from the previous chunk
+        after_error, previous_move_to_next_chunk, previous_copy_to_next_chunk = state
+        chunk_indices = indices[i]
+        if len(previous_move_to_next_chunk) > 0:
+            chunk_indices = np.sort(np.append(chunk_indices, previous_move_to_next_chunk))
+        if len(previous_copy_to_next_chunk) > 0:
+            chunk_indices = np.sort(np.append(chunk_indices, previous_copy_to_next_chunk))
+        indices[i] = chunk_indices
+
+        # For chunks with errors do noting as they are anyway discarded, ignore chunks without data
+        if errors[i] != 0 or len(chunk_indices) == 0:
+            state = (errors[i] != 0, no_indices, no_indices)
+        else:
+            indices[i], chunk_errors, removed_packages[i], state = correct_chunk(raw_data, scan_id, chunk_indices, after_error, previous_move_to_next_chunk, i + 1 < len(indices) or not last_chunk)
+            errors[i] += chunk_errors
+        states.append(state)
+    return indices, errors, removed_packages, states
+
+def correct_range(args):
+    # Correct a range of chunks in a worker
+    input_filename, raw_data_backend = args[:2]
+    return correct_chunks(get_raw_data(input_filename, raw_data_backend), *args[2:])
+
+def same_state(state, other_state):
+    return state[0] == other_state[0] and np.array_equal(state[1], other_state[1]) and np.array_equal(state[2], other_state[2])
+
+def error_correction(meta_data, raw_data, scan_id, start_chunk, stop_chunk, context_chunks=0, pool=None, ranges=1):
+    # The first context_chunks chunks are only corrected to get the words that are moved to the
+    # following chunk, their data is not returned and not counted in the statistics
+    # Read the data onto arrays
+    meta_data_tmp = meta_data[start_chunk:stop_chunk]
+    discard_errors = meta_data_tmp['discard_error']
+    decode_errors = meta_data_tmp['decode_error']
+    errors = discard_errors + decode_errors
+    start_indices = meta_data_tmp['index_start']
+    stop_indices = meta_data_tmp['index_stop']
+    scan_param_id = meta_data_tmp['scan_param_id']
+    chunk_start_time = meta_data_tmp['timestamp_start']
+    discarded_packages = 0
+    no_indices = np.zeros(0, dtype=int)
 
-        # Move only packages to the next chunk that were not already moved to the current chunk
-        move_to_next_chunk = np.setdiff1d(move_to_next_chunk, previous_move_to_next_chunk)
-
-        # Create the new indice lists for the current and the next chunk
-        new_indices = chunk_indices
-        if len(removed_indices) > 0:
-            new_indices = np.setdiff1d(new_indices, removed_indices)
-            discarded_packages += len(removed_indices)
-        if i + 1 < len(indices) and len(move_to_next_chunk) > 0:
-            indices[i+1] = np.append(indices[i+1], move_to_next_chunk)
-            indices[i+1] = np.sort(indices[i+1])
-            new_indices = np.setdiff1d(new_indices, move_to_next_chunk)
-        if i + 1 < len(indices) and len(copy_to_next_chunk) > 0:
-            indices[i+1] = np.append(indices[i+1], copy_to_next_chunk)
-            indices[i+1] = np.sort(indices[i+1])
-
-        previous_move_to_next_chunk = move_to_next_chunk
-
-        indices[i] = new_indices
-        i += 1
-    
+    print("Correct data")
+
+    if pool is None or ranges < 2 or len(errors) < 2 * ranges:
+        indices, errors, removed_packages, states = correct_chunks(raw_data, scan_id, start_indices, stop_indices, errors, (False, no_indices, no_indices), True, progress=True)
+    else:
+        # Correct ranges of chunks with about the same number of words in parallel. Each range starts
+        # as if nothing is moved or copied into its first chunk from the previous range
+        words = np.cumsum(stop_indices.astype(np.int64) - start_indices)
+        cuts = np.unique(np.searchsorted(words, np.arange(1, ranges) * (words[-1] / ranges)))
+        bounds = np.concatenate(([0], cuts[(cuts > 0) & (cuts < len(errors))], [len(errors)]))
+        args = []
+        for first, last in zip(bounds[:-1], bounds[1:]):
+            assumed_state = (first > 0 and errors[first - 1] != 0, no_indices, no_indices)
+            args.append([raw_data.input_filename, raw_data.backend, scan_id, start_indices[first:last], stop_indices[first:last], errors[first:last], assumed_state, last == len(errors)])
+        results = list(tqdm(pool.imap(correct_range, args), total=len(args), desc="Range"))
+
+        # Reconcile the joins of the ranges: the first chunks of a range are corrected again with the actual
+        # state after the previous range until the state after a chunk is the same as in the parallel correction.
+        # From there on the following chunks do not change
+        indices = np.empty(len(errors), dtype=object)
+        removed_packages = np.zeros(len(errors), dtype=np.int64)
+        corrected_errors = np.array(errors)
+        state = (False, no_indices, no_indices)
+        for (first, last), range_args, (range_indices, range_errors, range_removed_packages, range_states) in zip(zip(bounds[:-1], bounds[1:]), args, results):
+            assumed_state = range_args[6]
+            i = first
+            while i < last and not same_state(state, assumed_state):
+                chunk_indices, chunk_errors, chunk_removed_packages, chunk_states = correct_chunks(raw_data, scan_id, start_indices[i:i+1], stop_indices[i:i+1], errors[i:i+1], state, i + 1 == len(errors))
+                range_indices[i - first] = chunk_indices[0]
+                range_errors[i - first] = chunk_errors[0]
+                range_removed_packages[i - first] = chunk_removed_packages[0]
+                assumed_state = range_states[i - first]
+                state = chunk_states[0]
+                i += 1
+            if i < last:
+                state = range_states[-1]
+            indices[first:last] = range_indices
+            corrected_errors[first:last] = range_errors
+            removed_packages[first:last] = range_removed_packages
+        errors = corrected_errors
+
+    discarded_packages += int(np.sum(removed_packages[context_chunks:]))
     j = 0
     for chunk_errors in errors:
-        if chunk_errors > 0:
+        if chunk_errors > 0 and j >= context_chunks:
             discarded_packages += len(indices[j])
         j += 1
+    errors[:context_chunks] += 1
     indices = indices[np.where(errors == 0)[0]]
-    print("Discarded packages", discarded_packages, "of", stop_indices[-1]-start_indices[0], "(", 100. * (discarded_packages / (stop_indices[-1]-start_indices[0])), "%)")
-    return indices, scan_param_id, chunk_start_time, start_indices
-
-if len(sys.argv) == 3 or len(sys.argv) == 6:
-    input_filename = sys.argv[1]
-    output_filename = sys.argv[2]
-    if len(sys.argv) == 6:
-        timewalk_a = float(sys.argv[3])
-        timewalk_b = float(sys.argv[4])
-        timewalk_c = float(sys.argv[5])
-        timewalk_calib = True
-    else:
-        timewalk_a = 1
-        timewalk_b = 1
-        timewalk_c = 1
-        timewalk_calib = False
-    if not input_filename.endswith('.h5'):
-        print("Please choose a valid input file")
-    if not output_filename.endswith('.h5'):
-        print("Please choose a valid output file")
-
-    print("Start interpretation of data ", input_filename)
-
-    with tb.open_file(input_filename, 'r') as h5_file_in:
-        # Read the meta data and the chip configuration from the hdf5 file
-        meta_data = h5_file_in.root.meta_data[:]
-        run_config = h5_file_in.root.configuration.run_config[:]
-        general_config = h5_file_in.root.configuration.generalConfig[:]
-        op_mode = [row[1] for row in general_config if row[0]==b'Op_mode'][0]
-        vco = [row[1] for row in general_config if row[0]==b'Fast_Io_en'][0]
-        scan_id = [row[1] for row in run_config if row[0]==b'scan_id'][0].decode()
-
-        chunks = meta_data.shape[0]
-        print("There are ", chunks, "in the file")
-        new_interpretation = True
-
+    packages = stop_indices[-1]-start_indices[context_chunks]
+    print("Discarded packages", discarded_packages, "of", packages, "(", 100. * (discarded_packages / packages), "%)")
+    return indices, scan_param_id, chunk_start_time, start_indices, discarded_packages
+
+def select_chunks(meta_data, scan_param_ids=None, chunk_range=None, time_range=None):
+    # Select chunks based on the meta data: by scan parameter ids, by a range of chunks
+    # and by a time window (in the units of the chunk timestamps) that overlaps with the chunk
+    selected = np.ones(meta_data.shape[0], dtype=bool)
+    if scan_param_ids is not None:
+        selected &= np.isin(meta_data['scan_param_id'], scan_param_ids)
+    if chunk_range is not None:
+        chunk_selection = np.zeros(meta_data.shape[0], dtype=bool)
+        chunk_selection[chunk_range[0]:chunk_range[1]] = True
+        selected &= chunk_selection
+    if time_range is not None:
+        selected &= (meta_data['timestamp_stop'] > time_range[0]) & (meta_data['timestamp_start'] < time_range[1])
+    return selected
+
+def split_chunk(chunk_indices, words, scan_id):
+    # Split a chunk at positions where each link (and the ToA extension) has the same number of word 0 and
+    # word 1 before the position. Then the words are paired in the parts exactly as in the full chunk
+    word_types = []
+    if scan_id == 'DataTake':
+        timestamp_map = np.right_shift(np.bitwise_and(words, 0xf0000000), 28) == 0b0101
+        timestamp_types = np.right_shift(np.bitwise_and(words, 0x3000000), 24)
+        word_types.append((timestamp_map & (timestamp_types == 0b01), timestamp_map & (timestamp_types == 0b10)))
+    link_headers = np.right_shift(np.bitwise_and(words, 0xfe000000), 24)
+    link_types = np.right_shift(np.bitwise_and(words, 0x1000000), 24)
+    for link in range(8):
+        link_map = link_headers == 2 * link
+        word_types.append((link_map & (link_types == 0b0), link_map & (link_types == 0b1)))
+
+    balanced = np.ones(len(words), dtype=bool)
+    for words0_map, words1_map in word_types:
+        balanced[1:] &= np.cumsum(words0_map.astype(np.int64) - words1_map)[:-1] == 0
+    balanced[0] = False
+
+    # Use the first possible position after each multiple of the maximum task size
+    positions = np.where(balanced)[0]
+    if len(positions) == 0:
+        return [chunk_indices]
+    cuts = np.searchsorted(positions, np.arange(task_words_max, len(words), task_words_max))
+    cuts = np.unique(positions[cuts[cuts < len(positions)]])
+    parts = np.split(chunk_indices, cuts)
+
+    # Each part gets the last ToA extension before it, as the next chunk gets it in the error correction
+    if scan_id == 'DataTake':
+        timestamps_0 = np.where(word_types[0][0])[0]
+        timestamps_1 = np.where(word_types[0][1])[0]
+        for part, cut in enumerate(cuts):
+            last = np.searchsorted(timestamps_0, cut)
+            if last > 0:
+                extension = chunk_indices[[timestamps_1[last - 1], timestamps_0[last - 1]]]
+                parts[part + 1] = np.concatenate((np.sort(extension), parts[part + 1]))
+    return parts
+
+def split_units(indices, raw_data, scan_id):
+    # Create the units of the interpretation tasks from the corrected chunks: empty chunks are
+    # skipped and chunks with more than task_words_max words are split
+    units = []
+    for chunk_indices in indices:
+        if len(chunk_indices) == 0:
+            continue
+        if len(chunk_indices) > task_words_max:
+            units.extend(split_chunk(chunk_indices, raw_data.read(chunk_indices), scan_id))
+        else:
+            units.append(chunk_indices)
+    return units
+
+def plan_task(units, first_unit, words):
+    # Combine consecutive units starting with first_unit to a task with about words words. Returns the
+    # raw data indices and the unit lengths of the task and the first unit after the task
+    task_units = [units[first_unit]]
+    task_words = len(units[first_unit])
+    unit = first_unit + 1
+    while unit < len(units) and task_words + len(units[unit]) <= words:
+        task_units.append(units[unit])
+        task_words += len(units[unit])
+        unit += 1
+    return np.concatenate(task_units), np.array([len(task_unit) for task_unit in task_units]), unit
+
+def adapt_task_words(words, latency):
+    # Scale the task size to reach the target latency per task, by at most a factor 2 at once
+    factor = min(max(task_latency / max(latency, 1e-6), 0.5), 2.)
+    return int(min(max(words * factor, task_words_min), task_words_max))
+
+def plan_slices(meta_data, selected=None):
+    # Create the slices (first, start, stop) of consecutive selected chunks. The chunks from first
+    # to start are only needed as context for the error correction at the start of a selected range
+    chunks = meta_data.shape[0]
+    if selected is None:
+        selected = np.ones(chunks, dtype=bool)
+
+    # Ranges of consecutive selected chunks
+    edges = np.diff(np.concatenate(([0], selected.astype(np.int8), [0])))
+    range_starts = np.where(edges == 1)[0]
+    range_stops = np.where(edges == -1)[0]
+
+    slices = []
+    for range_start, range_stop in zip(range_starts, range_stops):
         # For files with a lot chunks slice it based on packages
-        if chunks > 50000:
-            start = 0
-            stop = 0
-            
-            while stop < chunks:
+        if range_stop - range_start <= slice_chunks:
+            range_slices = [(range_start, range_stop)]
+        else:
+            range_slices = []
+            start = range_start
+            stop = range_start
+            while stop < range_stop:
                 n=0
                 # Add chunks to the current slice until there are 400 million packages
-                while n<400000000:
-                    if stop == chunks:
+                while n<slice_packages:
+                    if stop == range_stop:
                         break
                     else:
                         stop +=1
                         n += meta_data[stop-1]['data_length']
-
-                print('Analyse chunks ' + str(start) + ' to ' + str(stop))
-                indices, scan_param_id, chunk_start_time, start_indices = error_correction(meta_data, h5_file_in, start, stop)
-                
-                args = []
-                print("Prepare interpretation")
-                for index_list in tqdm(indices, desc="Chunk"):
-                    if len(index_list) == 0:
-                        print("no data in chunk")
-                        continue
-                    args.append([input_filename, index_list, op_mode, vco, scan_id, scan_param_id, chunk_start_time, start_indices, timewalk_calib, timewalk_a, timewalk_b, timewalk_c])
-                print("args ",len(args))
-                print("indices ", len(indices))
-                print("Interpret data")
-                if len(args) == 0:
-                    start = stop
-                    continue
-                num_threads = multiprocessing.cpu_count()
-                with multiprocessing.Pool(num_threads-1) as pool:
-                    pix_data = list(tqdm(pool.imap(interpret_data, args, 100), total=len(args), desc="Chunk"))
-                pix_data = np.concatenate(pix_data)
-
-                print("Order data by timestamp")
-                pix_data = pix_data[pix_data['TOA_Combined'].argsort()]
-                if new_interpretation:
-                    save_data(h5_file_in, output_filename, pix_data, False)
-                    new_interpretation = False
-                else:
-                    save_data(h5_file_in, output_filename, pix_data, True)
-                pix_data = []
+                range_slices.append((start, stop))
                 start = stop
-        else:
-            indices, scan_param_id, chunk_start_time, start_indices = error_correction(meta_data, h5_file_in, 0, chunks)
-            args = []
-            print("Prepare interpretation")
-            for index_list in tqdm(indices, desc="Chunk"):
-                args.append([input_filename, index_list, op_mode, vco, scan_id, scan_param_id, chunk_start_time, start_indices, timewalk_calib, timewalk_a, timewalk_b, timewalk_c])
-
-            print("Interpret data")
-            num_threads = multiprocessing.cpu_count()
-            with multiprocessing.Pool(num_threads-1) as pool:
-                pix_data = list(tqdm(pool.imap(interpret_data, args, 100), total=len(args), desc="Chunk"))
-            pix_data = np.concatenate(pix_data)
 
+        # Only the first slice of a range needs the previous chunk, consecutive slices are corrected independently
+        for start, stop in range_slices:
+            first = start - 1 if start == range_start and start > 0 else start
+            slices.append((int(first), int(start), int(stop)))
+    return slices
+
+class Interpreter:
+    # Interpretation of a raw data file into an output file, which can also be used from other python code:
+    #   statistics = Interpreter('raw_data.h5', 'interpreted.h5', timewalk=(a, b, c)).run()
+    # The tasks are executed by the backend 'process' (worker processes), 'thread' (threads in this process),
+    # 'serial' (one after the other in this thread) or 'auto' (see select_backend). A pool created with
+    # multiprocessing.Pool(workers, initializer=init_luts) can be given to reuse the worker processes
+    # for several interpretations. With frames (a window of TOA_Combined) a FrameBuilder builds frames of the hits
+    def __init__(self, input_filename, output_filename, timewalk=None, workers=None, resume=False,
+                 scan_param_ids=None, chunk_range=None, time_range=None, raw_reader='auto', pool=None, buffer_dir=None,
+                 backend='process', parallel_write=False, frames=None, frame_mode='counts', frame_time_range=None):
+        self.input_filename = input_filename
+        self.output_filename = output_filename
+        if timewalk is None:
+            self.timewalk_calib = False
+            self.timewalk_a, self.timewalk_b, self.timewalk_c = 1, 1, 1
+        elif len(timewalk) == 3:
+            self.timewalk_calib = True
+            self.timewalk_a, self.timewalk_b, self.timewalk_c = timewalk
+        else:
+            raise ValueError("Three timewalk calibration parameters (a, b, c) are needed")
+        self.workers = workers if workers else max(multiprocessing.cpu_count() - 1, 1)
+        self.resume = resume
+        self.scan_param_ids = scan_param_ids
+        self.chunk_range = chunk_range
+        self.time_range = time_range
+        self.raw_reader = raw_reader
+        self.pool = pool
+        self.buffer_dir = buffer_dir
+        if backend not in ['process', 'thread', 'serial', 'auto']:
+            raise ValueError("Unknown backend " + str(backend))
+        self.backend = backend
+        self.parallel_write = parallel_write
+        if parallel_write and h5py is None:
+            print("Parallel writing of the output needs h5py, the hits are written by one process")
+        self.frames = frames
+        self.frame_mode = frame_mode
+        self.frame_time_range = frame_time_range
+        self.task_words = task_words
+
+    def run(self):
+        # Interpret the selected chunks of the input file and return statistics of the interpretation
+        print("Start interpretation of data ", self.input_filename)
+        start_time = time.time()
+        statistics = {'chunks': 0, 'slices': 0, 'hits': 0, 'packages': 0, 'discarded_packages': 0, 'dropped_units': 0, 'dropped_hits': 0, 'failed_tasks': 0}
+
+        with tb.open_file(self.input_filename, 'r') as h5_file_in:
+            # Read the meta data and the chip configuration from the hdf5 file
+            meta_data = h5_file_in.root.meta_data[:]
+            run_config = h5_file_in.root.configuration.run_config[:]
+            general_config = h5_file_in.root.configuration.generalConfig[:]
+            self.op_mode = [row[1] for row in general_config if row[0]==b'Op_mode'][0]
+            self.vco = [row[1] for row in general_config if row[0]==b'Fast_Io_en'][0]
+            self.scan_id = [row[1] for row in run_config if row[0]==b'scan_id'][0].decode()
+
+            chunks = meta_data.shape[0]
+            print("There are ", chunks, "in the file")
+            if self.scan_param_ids is not None or self.chunk_range is not None or self.time_range is not None:
+                selected = select_chunks(meta_data, self.scan_param_ids, self.chunk_range, self.time_range)
+                print("Selected", np.count_nonzero(selected), "of", chunks, "chunks")
+                if not np.any(selected):
+                    raise InterpretationError("No chunks match the selection")
+            else:
+                selected = None
+            slices = plan_slices(meta_data, selected)
+
+            # The progress in the output file is only valid for the same input and settings, the input
+            # is identified by its name, the number of raw data words and checksums of the meta data and
+            # of the first and last raw data words
+            raw_data_words = h5_file_in.root.raw_data.nrows
+            raw_data_ends = np.concatenate((h5_file_in.root.raw_data[:min(raw_data_words, 4096)], h5_file_in.root.raw_data[max(raw_data_words - 4096, 0):]))
+            progress_attributes = {'input_file': os.path.basename(self.input_filename),
+                                   'chunks': chunks,
+                                   'raw_words': int(meta_data[-1]['index_stop']) if chunks > 0 else 0,
+                                   'meta_data_crc': zlib.crc32(np.ascontiguousarray(meta_data).tobytes()),
+                                   'raw_data_crc': zlib.crc32(np.ascontiguousarray(raw_data_ends).tobytes()),
+                                   'slice_packages': slice_packages,
+                                   'selection': str(self.selection()),
+                                   'timewalk': np.array([self.timewalk_calib, self.timewalk_a, self.timewalk_b, self.timewalk_c], dtype=float)}
+            new_interpretation = True
+            total_hits = 0
+            if self.resume:
+                progress = load_progress(self.output_filename, progress_attributes)
+                if progress is None:
+                    raise InterpretationError("Can not resume the interpretation in " + self.output_filename)
+                completed = [(int(row['slice_start']), int(row['slice_stop'])) for row in progress]
+                if [(start, stop) for first, start, stop in slices[:len(completed)]] != completed:
+                    raise InterpretationError("Completed slices do not match the slices of the input file - can not resume")
+                slices = slices[len(completed):]
+                total_hits = int(progress['total_hits'][-1])
+                new_interpretation = False
+                print("Resume after", len(completed), "completed slices with", total_hits, "hits")
+
+            frame_builder = None
+            if self.frames is not None:
+                frame_builder = FrameBuilder(self.output_filename, self.frames, self.frame_mode, self.frame_time_range)
+                # The frames of a resumed interpretation are built again from the hits in the output file
+                if not new_interpretation:
+                    print("Build frames of the completed slices")
+                    frame_builder.add_file(self.output_filename)
+
+            raw_data = get_raw_data(self.input_filename, self.raw_reader)
+            print("Read raw data with", type(raw_data).__name__)
+            # The workers use the same backend without checking the layout again
+            self.raw_data_backend = raw_data.backend
+
+            # A given pool determines the backend, otherwise 'auto' selects it
+            if self.pool is not None:
+                if self.backend not in ['auto', pool_backend(self.pool)]:
+                    print("The given pool runs the tasks with the", pool_backend(self.pool), "backend instead of", self.backend)
+                self.backend = pool_backend(self.pool)
+            elif self.backend == 'auto':
+                self.backend = select_backend(self.workers)
+            print("Interpret with the", self.backend, "backend")
+            try:
+                with (self.create_pool() if self.pool is None else contextlib.nullcontext(self.pool)) as pool:
+                    for first, start, stop in slices:
+                        if len(slices) > 1 or selected is not None:
+                            print('Analyse chunks ' + str(start) + ' to ' + str(stop))
+                        indices, scan_param_id, chunk_start_time, start_indices, discarded_packages = error_correction(meta_data, raw_data, self.scan_id, first, stop, start - first, pool, self.correction_ranges())
+                        pix_data, decode_stats, hits_filename = self.interpret_slice(pool, raw_data, indices, scan_param_id, chunk_start_time, start_indices)
+                        hits = len(pix_data)
+                        try:
+                            save_data(h5_file_in, self.output_filename, pix_data, not new_interpretation, pool if self.parallel_write else None, 4 * self.workers, hits_filename)
+                            new_interpretation = False
+                            if frame_builder is not None:
+                                frame_builder.add(pix_data)
+                        finally:
+                            pix_data = None
+                            if hits_filename is not None:
+                                os.remove(hits_filename)
+
+                        # Record the completed slice with the raw data range that was covered
+                        total_hits += hits
+                        progress = np.array([(start, stop, meta_data[start]['index_start'], meta_data[stop-1]['index_stop'], hits, total_hits)], dtype=progress_type)
+                        decode_stats['slice_start'] = start
+                        decode_stats['slice_stop'] = stop
+                        save_progress(self.output_filename, progress, progress_attributes, decode_stats)
+                        if decode_stats['dropped_units'][0] > 0:
+                            print("Dropped", decode_stats['dropped_units'][0], "units with", decode_stats['dropped_hits'][0], "hits (" + str(decode_stats['failed_tasks'][0]), "failed tasks)")
+
+                        statistics['chunks'] += stop - start
+                        statistics['slices'] += 1
+                        statistics['hits'] += hits
+                        statistics['packages'] += int(meta_data[stop-1]['index_stop']) - int(meta_data[start]['index_start'])
+                        statistics['discarded_packages'] += discarded_packages
+                        statistics['dropped_units'] += int(decode_stats['dropped_units'][0])
+                        statistics['dropped_hits'] += int(decode_stats['dropped_hits'][0])
+                        statistics['failed_tasks'] += int(decode_stats['failed_tasks'][0])
+                    if frame_builder is not None and not new_interpretation:
+                        statistics['frames'] = frame_builder.close()
+            finally:
+                close_raw_data(self.input_filename)
+
+        statistics['total_hits'] = total_hits
+        statistics['time'] = time.time() - start_time
+        return statistics
+
+    def selection(self):
+        # The chunk selection with the same types for the options of the API and the command line
+        return [None if self.scan_param_ids is None else [int(scan_param_id) for scan_param_id in self.scan_param_ids],
+                None if self.chunk_range is None else [int(chunk) for chunk in self.chunk_range],
+                None if self.time_range is None else [float(time) for time in self.time_range]]
+
+    def correction_ranges(self):
+        # The error correction is split into ranges of chunks for the workers, the serial backend and
+        # a single worker correct the slice at once
+        if self.backend == 'serial' or self.workers < 2:
+            return 1
+        return 4 * self.workers
+
+    def create_pool(self):
+        # Threads and the serial backend use the look up tables of this process. With fork the worker
+        # processes get them from this process, otherwise each worker creates them once
+        if self.backend == 'serial':
+            init_luts()
+            return SerialPool()
+        if self.backend == 'thread':
+            init_luts()
+            return multiprocessing.pool.ThreadPool(self.workers)
+        if multiprocessing.get_start_method() == 'fork':
+            init_luts()
+        return multiprocessing.Pool(self.workers, initializer=init_luts)
+
+    def interpret_slice(self, pool, raw_data, indices, scan_param_id, chunk_start_time, start_indices):
+        # Interpret the corrected chunks of a slice with the worker pool and return the hits ordered by timestamp,
+        # the summed decode statistics of the tasks and the file name of a memory mapped copy of the hits (only for
+        # the parallel writing with worker processes, otherwise None). The caller removes this file
+        print("Prepare interpretation")
+        units = split_units(indices, raw_data, self.scan_id)
+        print("units ", len(units))
+        print("indices ", len(indices))
+        print("Interpret data")
+        if len(units) == 0:
+            return np.recarray((0), dtype=hit_data_type), sum_decode_stats([]), None
+
+        # The workers write the hits into a buffer (memory mapped for worker processes of the pool), each task
+        # has a region with space for one hit per two words of the task
+        capacity = max(sum(len(unit_indices) for unit_indices in units) // 2, 1)
+        buffer_filename = None
+        try:
+            if pool_backend(pool) == 'process':
+                buffer_filename = create_hit_file(self.buffer_dir, capacity)
+                buffer = np.memmap(buffer_filename, dtype=hit_data_type, mode='r+', shape=(capacity,))
+            else:
+                buffer = np.empty(capacity, dtype=hit_data_type)
+            results = []
+            offset = 0
+            with tqdm(total=len(units), desc="Chunk") as progress_bar:
+                # Up to 4 tasks per worker are in flight. A new task is planned when a task is completed,
+                # with the task size adapted to the run time of the completed task
+                done = queue.Queue()
+                running = 0
+                unit = 0
+                while unit < len(units) or running > 0:
+                    while unit < len(units) and running < 4 * self.workers:
+                        raw_indices, unit_lengths, next_unit = plan_task(units, unit, self.task_words)
+                        args = [self.input_filename, raw_indices, unit_lengths, self.op_mode, self.vco, self.scan_id, scan_param_id, chunk_start_time, start_indices, self.timewalk_calib, self.timewalk_a, self.timewalk_b, self.timewalk_c, self.raw_data_backend, buffer_filename if buffer_filename is not None else buffer, offset, len(raw_indices) // 2]
+                        task = (len(raw_indices), next_unit - unit)
+                        pool.apply_async(interpret_task, (args,), callback=lambda result, task=task: done.put((result, task)), error_callback=done.put)
+                        offset += len(raw_indices) // 2
+                        unit = next_unit
+                        running += 1
+                    result = done.get()
+                    running -= 1
+                    if isinstance(result, BaseException):
+                        raise result
+                    (task_offset, hits, stats, run_time), (words, task_units) = result
+                    results.append((task_offset, hits, stats))
+                    self.task_words = adapt_task_words(self.task_words, run_time * self.task_words / max(words, 1))
+                    progress_bar.update(task_units)
+
+            # Order the hits of all regions by timestamp and copy them once out of the buffer
             print("Order data by timestamp")
-            pix_data = pix_data[pix_data['TOA_Combined'].argsort()]
-            save_data(h5_file_in, output_filename, pix_data)
+            # (the tasks complete in any order, the regions are ordered by offset to get the same order in each run)
+            positions = np.concatenate([np.arange(offset, offset + hits) for offset, hits, stats in sorted(results, key=lambda result: result[0])])
+            positions = positions[np.argsort(buffer['TOA_Combined'][positions], kind='stable')]
+            hits_filename = None
+            if self.parallel_write and h5py is not None and pool_backend(pool) == 'process':
+                # The workers that compress the output read the ordered hits from a memory mapped file
+                hits_filename = create_hit_file(self.buffer_dir, len(positions))
+                pix_data = np.memmap(hits_filename, dtype=hit_data_type, mode='r+', shape=(max(len(positions), 1),))[:len(positions)]
+                pix_data[:] = buffer[positions]
+                pix_data.flush()
+                pix_data = np.asarray(pix_data).view(np.recarray)
+            else:
+                pix_data = np.asarray(buffer[positions]).view(np.recarray)
+        finally:
+            buffer = None
+            if buffer_filename is not None:
+                os.remove(buffer_filename)
+        return pix_data, sum_decode_stats([stats for offset, hits, stats in results]), hits_filename
+
+def create_synthetic_raw_data(filename, hits=1000000, seed=0):
+    # Write random hits on all links with ToA extensions as raw data file for benchmarks
+    rng = np.random.default_rng(seed)
+    link = rng.integers(0, 8, hits).astype(np.uint64)
+    toa = rng.integers(0, 2 ** 14, hits).astype(np.uint64)
+    data = (np.uint64(0xb) << np.uint64(44)) | (rng.integers(0, 2 ** 16, hits).astype(np.uint64) << np.uint64(28)) | ((toa ^ (toa >> np.uint64(1))) << np.uint64(14)) | rng.integers(0, 2 ** 14, hits).astype(np.uint64)
+
+    # The 24 bits of each word are stored in reversed byte order
+    def words(bits):
+        return (bits & np.uint64(0xff)) << np.uint64(16) | (bits & np.uint64(0xff00)) | (bits >> np.uint64(16)) & np.uint64(0xff)
+
+    # Each hit is sent as word 1 and word 0, after every 16 hits follow the two words of a ToA extension
+    raw_data = np.zeros((hits // 16 + 1, 34), dtype=np.uint64)
+    hit_words = np.zeros(raw_data.shape[0] * 16 * 2, dtype=np.uint64)
+    hit_words[0:2 * hits:2] = (link << np.uint64(25)) | np.uint64(0x1000000) | words(data & np.uint64(0xffffff))
+    hit_words[1:2 * hits:2] = (link << np.uint64(25)) | words(data >> np.uint64(24))
+    raw_data[:, 2:] = hit_words.reshape(-1, 32)
+    extensions = np.arange(raw_data.shape[0], dtype=np.uint64) << np.uint64(12)
+    raw_data[:, 0] = np.uint64(0x52000000) | (extensions >> np.uint64(24))
+    raw_data[:, 1] = np.uint64(0x51000000) | (extensions & np.uint64(0xfff000))
+    raw_data = raw_data.reshape(-1)[:len(raw_data.reshape(-1)) - (raw_data.shape[0] * 16 - hits) * 2].astype(np.uint32)
+
+    with tb.open_file(filename, 'w') as h5_file:
+        h5_file.create_earray(h5_file.root, 'raw_data', obj=raw_data, filters=tb.Filters(complib='blosc', complevel=5))
+    return len(raw_data)
+
+def benchmark_backends(workers=None, hits=2000000, backends=('process', 'thread', 'serial')):
+    # Compare the backends for the interpretation of synthetic data and return the time for each backend
+    directory = tempfile.mkdtemp()
+    try:
+        input_filename = os.path.join(directory, 'raw_data.h5')
+        words = create_synthetic_raw_data(input_filename, hits)
+        indices = np.empty(words // 10000 + 1, dtype=object)
+        indices[:] = [np.arange(start, min(start + 10000, words)) for start in range(0, words, 10000)]
+
+        interpreter = Interpreter(input_filename, os.path.join(directory, 'interpreted.h5'), workers=workers)
+        interpreter.op_mode = 0b00
+        interpreter.vco = False
+        interpreter.scan_id = 'DataTake'
+        interpreter.raw_data_backend = 'hdf5'
+        raw_data = get_raw_data(input_filename, 'hdf5')
+        times = {}
+        for backend in backends:
+            interpreter.backend = backend
+            interpreter.task_words = task_words
+            start_time = time.time()
+            with interpreter.create_pool() as pool:
+                interpreter.interpret_slice(pool, raw_data, indices, np.zeros(1, dtype=np.uint16), np.zeros(1), np.zeros(1, dtype=int))
+            times[backend] = time.time() - start_time
+        close_raw_data(input_filename)
+    finally:
+        shutil.rmtree(directory)
+    return times
+
+def select_backend(workers):
+    # Without the GIL (free-threaded python) the threads run in parallel, otherwise the fastest backend of
+    # a benchmark on this machine is used. The result is stored in the user cache directory
+    if hasattr(sys, '_is_gil_enabled') and not sys._is_gil_enabled():
+        return 'thread'
+    cache_filename = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'tpx3_interpretation', 'backend.json')
+    key = platform.node() + ' ' + platform.python_version() + ' ' + str(workers)
+    try:
+        with open(cache_filename) as cache_file:
+            cache = json.load(cache_file)
+    except (IOError, OSError, ValueError):
+        cache = {}
+    if key not in cache:
+        print("Benchmark the backends with", workers, "workers")
+        times = benchmark_backends(workers)
+        cache[key] = min(times, key=times.get)
+        try:
+            os.makedirs(os.path.dirname(cache_filename), exist_ok=True)
+            with open(cache_filename, 'w') as cache_file:
+                json.dump(cache, cache_file)
+        except (IOError, OSError):
+            print("Can not store the selected backend in", cache_filename)
+    return cache[key]
+
+def interpret(input_filename, output_filename, **options):
+    # Interpret a raw data file, see Interpreter for the options
+    return Interpreter(input_filename, output_filename, **options).run()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Interpretation of Timepix3 raw data recorded with tpx3-daq")
+    parser.add_argument('input_file', nargs='?', help="HDF5 file with the raw data")
+    parser.add_argument('output_file', nargs='?', help="HDF5 file for the interpreted data")
+    parser.add_argument('timewalk', nargs='*', type=float, metavar='timewalk_calib', help="Fit parameters a, b and c of the timewalk calibration")
+    parser.add_argument('--resume', action='store_true', help="Continue an interrupted interpretation after the last completed slice in the output file")
+    parser.add_argument('--scan-param-ids', nargs='+', type=int, metavar='ID', help="Only interpret chunks with these scan parameter ids")
+    parser.add_argument('--chunks', nargs=2, type=int, metavar=('START', 'STOP'), help="Only interpret the chunks from START to STOP")
+    parser.add_argument('--time-range', nargs=2, type=float, metavar=('START', 'STOP'), help="Only interpret chunks that overlap with this time window (same units as the meta data timestamps)")
+    parser.add_argument('--raw-reader', choices=['auto', 'memmap', 'hdf5'], default='auto', help="Read the raw data memory mapped (only for contiguous, uncompressed raw data) or with PyTables. 'auto' uses memory mapping if possible")
+    parser.add_argument('--repack', action='store_true', help="Do not interpret, but copy the input file to the output file with raw data that can be memory mapped")
+    parser.add_argument('--workers', type=int, help="Number of worker processes (default: number of cores - 1)")
+    parser.add_argument('--backend', choices=['process', 'thread', 'serial', 'auto'], default='process', help="Run the interpretation tasks in worker processes, threads or serial. 'auto' uses the fastest backend of a benchmark on this machine")
+    parser.add_argument('--parallel-write', action='store_true', help="Compress the output in parallel and write the compressed chunks directly (needs h5py)")
+    parser.add_argument('--frames', type=int, metavar='WINDOW', help="Build frames of the hits in windows of WINDOW TOA_Combined units (1 ms = 40000)")
+    parser.add_argument('--frame-mode', choices=['counts', 'tot'], default='counts', help="Number of hits or summed ToT per pixel in the frames")
+    parser.add_argument('--frame-time-range', nargs=2, type=int, metavar=('START', 'STOP'), help="Only build frames of hits in this TOA_Combined range")
+    parser.add_argument('--frames-only', action='store_true', help="Do not interpret, but build the frames of an interpreted input file (into the output file, default: the input file)")
+    parser.add_argument('--benchmark', action='store_true', help="Do not interpret, but compare the backends on synthetic data")
+    parser.add_argument('--buffer-dir', help="Directory for the temporary file in which the workers store the hits (default: system temporary directory)")
+    options = parser.parse_args(argv)
+
+    if options.benchmark:
+        times = benchmark_backends(options.workers)
+        for backend, backend_time in times.items():
+            print(backend, round(backend_time, 2), "s")
+        print("Fastest backend:", min(times, key=times.get))
+        return
+    if options.frames_only:
+        if options.input_file is None or options.frames is None:
+            parser.error("--frames-only needs an interpreted input file and --frames")
+        frames = build_frames(options.input_file, options.output_file if options.output_file is not None else options.input_file,
+                              options.frames, options.frame_mode, options.frame_time_range)
+        print("Wrote", frames, "frames")
+        return
+    if options.input_file is None or options.output_file is None:
+        parser.error("the input and the output file are required")
+    if options.repack:
+        repack_raw_data(options.input_file, options.output_file)
+        return
+    if len(options.timewalk) != 0 and len(options.timewalk) != 3:
+        print("Please enter either none or all three timewalk calibration parameters (python tpx3_interpretation.py <input path> <output path> <a> <b> <c>)")
+        sys.exit(1)
+    if not options.input_file.endswith('.h5'):
+        print("Please choose a valid input file")
+    if not options.output_file.endswith('.h5'):
+        print("Please choose a valid output file")
 
-else:
-    print("Please enter the data paths of the input and the output file (python tpx3_interpretation.py <input path> <output path>)")
+    interpreter = Interpreter(options.input_file, options.output_file,
+                              timewalk=options.timewalk if len(options.timewalk) == 3 else None,
+                              workers=options.workers,
+                              resume=options.resume,
+                              scan_param_ids=options.scan_param_ids,
+                              chunk_range=options.chunks,
+                              time_range=options.time_range,
+                              raw_reader=options.raw_reader,
+                              buffer_dir=options.buffer_dir,
+                              backend=options.backend,
+                              parallel_write=options.parallel_write,
+                              frames=options.frames,
+                              frame_mode=options.frame_mode,
+                              frame_time_range=options.frame_time_range)
+    try:
+        statistics = interpreter.run()
+    except InterpretationError as e:
+        print(e.message)
+        sys.exit(1)
+    print("Interpreted", statistics['hits'], "hits of", statistics['chunks'], "chunks in", round(statistics['time'], 1), "s")
+    if statistics['dropped_units'] > 0:
+        print("Dropped", statistics['dropped_units'], "units with", statistics['dropped_hits'], "hits, see interpreted/decode_stats")
+    if 'frames' in statistics:
+        print("Wrote", statistics['frames'], "frames")
+
+if __name__ == '__main__':
+    main()